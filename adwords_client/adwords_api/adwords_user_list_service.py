@@ -5,7 +5,8 @@ logger = logging.getLogger(__name__)
 
 
 class CustomSyncReturnValue(cm.SyncReturnValue):
-    def __init__(self, callback, parameters):
+    def __init__(self, callback, parameters, retry_policy=None):
+        self.retry_policy = retry_policy or cm.DEFAULT_RETRY_POLICY
         member_operations = [adw_op for adw_op in parameters if adw_op['xsi_type'] == 'MutateMembersOperation']
         regular_operations = [adw_op for adw_op in parameters if adw_op['xsi_type'] == 'UserListOperation']
 
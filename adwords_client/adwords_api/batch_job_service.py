@@ -1,9 +1,15 @@
 import logging
+import time
 from collections import OrderedDict
+from queue import Queue
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import Request
 
 import googleads
 
 from . import common as cm
+from adwords_client.adwords_api.batch_job_xml import BatchJobXmlSerializer, schemaless_operations_xml
 from adwords_client.adwords_api.operations.utils import batch_job_operation
 from adwords_client.internal_api.builder import OperationsBuilder
 
@@ -12,14 +18,25 @@ logger = logging.getLogger(__name__)
 
 class BatchJobHelper(googleads.adwords.BatchJobHelper):
 
-    def __init__(self, service):
+    def __init__(self, service, upload_url=None, current_content_length=0, uploaded_operations=0):
         request_builder = self.GetRequestBuilder(client=service.client)
         response_parser = self.GetResponseParser()
         super().__init__(request_builder=request_builder, response_parser=response_parser)
         self.operations = OrderedDict()     # Should honor the operation type insertion order
         self.last_operation = None
-        self.upload_helper = self.GetIncrementalUploadHelper(service.batch_job.result['value'][0].uploadUrl.url)
+        if upload_url is None:
+            upload_url = service.batch_job.result['value'][0].uploadUrl.url
+        self.upload_helper = self.GetIncrementalUploadHelper(upload_url, current_content_length)
         self._last_temporary_id = 0
+        # when set, the latency and the failures of the uploads are reported to this UploadChunker
+        self.chunker = None
+        # operations uploaded to the job, including the ones uploaded before a resume
+        self.uploaded_operations = uploaded_operations
+        # when set, called with the checkpoint of every successful upload
+        self.on_upload = None
+        self.retry_policy = service.retry_policy
+        # when set, a BatchJobXmlSerializer writing the operations instead of the googleads request builder
+        self.xml_serializer = service.xml_serializer
 
     def __getitem__(self, op_type, item):
         return self.operations[op_type][item]
@@ -44,25 +61,281 @@ class BatchJobHelper(googleads.adwords.BatchJobHelper):
         self._last_temporary_id -= 1
         return self._last_temporary_id
 
+    def take_operations(self):
+        """
+        Removes the queued operations from the helper, as the lists (one per operation type) to be uploaded
+        """
+        operations = list(self.operations.values())
+        self.operations = OrderedDict()
+        self.last_operation = None
+        return operations
+
+    def upload(self, operations, is_last=False):
+        self.upload_body(self.serialize(operations, is_last), operations, is_last)
+
+    def upload_body(self, body, operations, is_last=False):
+        """
+        Uploads a chunk already serialized by `serialize`, `operations` being the ones in it
+        """
+        if is_last:
+            logger.info('Uploading final data...')
+        else:
+            logger.info('Uploading intermediate data...')
+        # the chunk is serialized once and sent as is by every attempt
+        self.retry_policy.call(self._upload_attempt, body, is_last)
+        self.uploaded_operations += sum(len(operations_of_type) for operations_of_type in operations)
+        if self.on_upload:
+            self.on_upload(self.checkpoint(is_last))
+
+    def serialize(self, operations, is_last=False, has_prefix=None):
+        """
+        Unpadded body of the upload of a chunk, as `IncrementalUploadHelper.UploadOperations` builds it. Only
+        the first chunk of the job has the prefix, by default the chunk is the first if nothing was uploaded
+        yet, which does not hold for chunks serialized ahead of the uploads.
+        """
+        request_builder = self._request_builder
+        if has_prefix is None:
+            has_prefix = self.upload_helper._current_content_length == 0
+        if self.xml_serializer is None:
+            return request_builder._BuildUploadRequestBody(operations, has_prefix=has_prefix,
+                                                           has_suffix=is_last).encode('utf-8')
+        body = self.xml_serializer.serialize(operations, self.operations_xml)
+        if has_prefix:
+            body = (request_builder._UPLOAD_PREFIX_TEMPLATE % request_builder._adwords_endpoint).encode('utf-8') + body
+        if is_last:
+            body += request_builder._UPLOAD_SUFFIX.encode('utf-8')
+        return body
+
+    def operations_xml(self, operations):
+        """
+        XML of a list of operations of one type, as googleads writes them in the upload
+        """
+        return self._request_builder._GenerateOperationsXML(operations)
+
+    def _upload_attempt(self, body, is_last):
+        start = time.monotonic()
+        try:
+            self._send(body, is_last)
+        except Exception:
+            if self.chunker:
+                self.chunker.record(time.monotonic() - start, failed=True)
+            raise
+        if self.chunker:
+            self.chunker.record(time.monotonic() - start, is_last=is_last)
+
+    def _send(self, body, is_last):
+        # same request as IncrementalUploadHelper.UploadOperations, from an already serialized body
+        upload_helper = self.upload_helper
+        if upload_helper._is_last:
+            raise googleads.errors.AdWordsBatchJobServiceInvalidOperationError(
+                'Can\'t add new operations to a completed incremental upload.')
+        current_content_length = upload_helper._current_content_length
+        padding_length = self._request_builder._GetPaddingLength(len(body))
+        new_content_length = current_content_length + len(body) + padding_length
+        request = Request(upload_helper._upload_url, data=body + b' ' * padding_length, method='PUT')
+        request.add_header('Content-Type', 'application/xml')
+        request.add_header('Content-Length', len(body) + padding_length)
+        request.add_header('Content-Range', 'bytes {}-{}/{}'.format(current_content_length, new_content_length - 1,
+                                                                    new_content_length if is_last else '*'))
+        try:
+            upload_helper._url_opener.open(request)
+        except HTTPError as e:
+            # resumable uploads answer 308 until the last chunk
+            if e.code != 308:
+                raise
+        upload_helper._current_content_length = new_content_length
+        upload_helper._is_last = is_last
+
     def upload_operations(self, is_last=False):
-        fail_counter = 0
-        done = False
-        while not done:
-            try:
-                if is_last:
-                    logger.info('Uploading final data...')
+        self.upload(self.take_operations(), is_last=is_last)
+
+    def checkpoint(self, is_last=False):
+        """
+        State of the upload, from which a new helper can resume it (see `BatchJobService.resume_job`)
+        """
+        return {
+            'uploaded_operations': self.uploaded_operations,
+            'resume_url': self.upload_helper._upload_url,
+            'content_length': self.upload_helper._current_content_length,
+            'is_last': is_last,
+        }
+
+
+class UploadChunker:
+    """
+    Decides where the operations of a batch job are cut into upload chunks
+
+    A chunk is cut every `max_operations` operations and, with `target_bytes`, when the estimated size of
+    the chunk (the XML of its operations, as uploaded) would exceed the current target. Serializing every
+    operation would cost as much as building it, so only the first `exact_samples` operations of each
+    xsi_type and operator of a job and one in `sample_every` afterwards are measured, through a
+    `BatchJobXmlSerializer` over the reference given to `start_job`, the others are estimated as the average
+    size of the ones measured. The target starts at `target_bytes`
+    and adapts to the uploads reported with `record`, between `min_bytes` and `max_bytes`: a failed upload
+    halves it, an upload slower than `target_seconds` scales it down to what would have taken that long and
+    a full chunk uploaded in less than half of `target_seconds` grows it by a quarter.
+    """
+    def __init__(self, max_operations=None, target_bytes=None, max_bytes=None, min_bytes=262144,
+                 target_seconds=20.0, exact_samples=10, sample_every=100):
+        if target_bytes and max_bytes and max_bytes < target_bytes:
+            raise ValueError('max_bytes can not be smaller than target_bytes')
+        self.max_operations = max_operations
+        self.target_bytes = target_bytes
+        self.max_bytes = max_bytes or target_bytes
+        self.min_bytes = min(min_bytes, target_bytes) if target_bytes else min_bytes
+        self.target_seconds = target_seconds
+        self.exact_samples = exact_samples
+        self.sample_every = sample_every
+        # (xsi_type, operator) -> [operations seen, operations measured, total size of the measured ones]
+        self.sizes = {}
+        self.reference = schemaless_operations_xml
+        self.xml_serializer = BatchJobXmlSerializer()
+        self.uploads = 0
+        self.failures = 0
+        self.reset()
+
+    def reset(self):
+        self.operations = 0
+        self.bytes = 0
+
+    def start_job(self, reference=None):
+        """
+        Starts the first chunk of a new batch job, whose operations are measured again with `reference`, like
+        the `operations_xml` of its helper (`schemaless_operations_xml` by default, when there is no API)
+        """
+        self.reset()
+        self.sizes = {}
+        self.reference = reference or schemaless_operations_xml
+        self.xml_serializer = BatchJobXmlSerializer()
+
+    def estimate_size(self, operation):
+        """
+        Estimated size of the XML of the operation, see the sampling above
+        """
+        key = operation.get('xsi_type'), operation.get('operator')
+        sizes = self.sizes.get(key)
+        if sizes is None:
+            sizes = self.sizes[key] = [0, 0, 0]
+        seen = sizes[0]
+        sizes[0] += 1
+        if seen >= self.exact_samples and (seen - self.exact_samples) % self.sample_every:
+            return -(-sizes[2] // sizes[1])
+        size = len(self.xml_serializer.serialize([[operation]], self.reference))
+        sizes[1] += 1
+        sizes[2] += size
+        return size
+
+    def cut(self, operation):
+        """
+        Counts the operation in the current chunk and tells if the chunk must be uploaded before it
+        """
+        size = self.estimate_size(operation) if self.target_bytes else 0
+        cut = self.operations > 0 and (
+            (self.max_operations and self.operations >= self.max_operations)
+            or (self.target_bytes and self.bytes + size > self.target_bytes)
+        )
+        if cut:
+            self.reset()
+        self.operations += 1
+        self.bytes += size
+        return bool(cut)
+
+    def record(self, seconds, failed=False, is_last=False):
+        """
+        Adapts the target to the latency (in seconds) of an upload or to its failure
+        """
+        self.uploads += 1
+        if not self.target_bytes:
+            return
+        target = self.target_bytes
+        if failed:
+            self.failures += 1
+            target /= 2
+        elif seconds > self.target_seconds:
+            target *= self.target_seconds / seconds
+        elif seconds < self.target_seconds / 2 and not is_last:
+            # the final chunk is not full, so its speed tells nothing about bigger chunks
+            target *= 1.25
+        target = int(max(self.min_bytes, min(self.max_bytes, target)))
+        if target != self.target_bytes:
+            logger.debug('Upload chunk target changed from %s to %s bytes', self.target_bytes, target)
+            self.target_bytes = target
+
+
+class UploadPipeline:
+    """
+    Uploads the operations of a batch job in two background stages, so the next chunk can be built while
+    the previous one is serialized and the one before it is sent
+
+    `submit` takes the operations queued in the helper and returns as soon as there is room in a queue of
+    `max_pending` chunks. A serializing thread takes the chunks from that queue and passes their XML through
+    a second queue of `max_pending` bodies to an uploading thread, so at most about twice `max_pending`
+    chunks wait in memory. Chunks are uploaded in order, a failure in either stage stops the pipeline and
+    its error is raised on the next `submit` or on `close`.
+    """
+    def __init__(self, helper, max_pending=2):
+        self.helper = helper
+        self.queue = Queue(max_pending)
+        self.bodies = Queue(max_pending)
+        self.error = None
+        self.closed = False
+        # the chunks are serialized ahead of the uploads, so the prefix can not be decided from what was sent
+        self.has_prefix = helper.checkpoint()['content_length'] == 0
+        self.threads = [Thread(target=self._serialize, daemon=True), Thread(target=self._upload, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def _serialize(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                self.bodies.put(None)
+                break
+            if self.error is None:
+                operations, is_last = chunk
+                try:
+                    body = self.helper.serialize(operations, is_last, has_prefix=self.has_prefix)
+                except Exception as e:
+                    self.error = e
                 else:
-                    logger.info('Uploading intermediate data...')
-                self.upload_helper.UploadOperations(list(self.operations.values()), is_last=is_last)
-                self.operations = {}
-                self.last_operation = None
-                done = True
-            except Exception as e:
-                fail_counter += 1
-                if fail_counter > 2:
-                    logger.error('Problem uploading the data, failure...')
-                    raise e
-                logger.error('Problem uploading the data, retrying...')
+                    self.has_prefix = False
+                    self.bodies.put((body, operations, is_last))
+
+    def _upload(self):
+        while True:
+            chunk = self.bodies.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                body, operations, is_last = chunk
+                try:
+                    self.helper.upload_body(body, operations, is_last=is_last)
+                except Exception as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, is_last=False):
+        self._check()
+        self.queue.put((self.helper.take_operations(), is_last))
+
+    def close(self, error=None):
+        """
+        Waits for the pending uploads to finish. `error` is the exception being handled when the pipeline is
+        closed because of it: the error of a failed upload is then logged instead of raised, so it does not
+        replace that exception.
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+        if error is None:
+            self._check()
+        elif self.error is not None and self.error is not error:
+            logger.error('Upload failed while handling %r', error, exc_info=self.error)
 
 
 class BatchJobOperations:
@@ -81,6 +354,7 @@ class BatchJobService(cm.BaseService):
         super().__init__(client, 'BatchJobService')
         self.batch_job = None
         self.helper = None
+        self.xml_serializer = None
 
     def get_wholeoperation_id(self):
         try:
@@ -99,6 +373,19 @@ class BatchJobService(cm.BaseService):
         logger.info('Created new batchjob:\n%s', self.batch_job)
         self.helper = BatchJobHelper(self)
 
+    def resume_job(self, client_customer_id, checkpoint):
+        """
+        Continues the upload of an existing job from the checkpoint of its helper, along with the `upload_url`
+        of the job
+        """
+        self.client.SetClientCustomerId(client_customer_id)
+        self.batch_job = None
+        content_length = checkpoint.get('content_length', 0)
+        # the resumable upload session only exists after the first chunk, otherwise a new one is started
+        upload_url = checkpoint['resume_url'] if content_length else checkpoint['upload_url']
+        logger.info('Resuming batchjob %s at byte %s', checkpoint.get('batchjob_id'), content_length)
+        self.helper = BatchJobHelper(self, upload_url, content_length, checkpoint.get('uploaded_operations', 0))
+
     def cancel_jobs(self, jobs, client_id=None):
         self.prepare_mutate()
         for job in jobs:
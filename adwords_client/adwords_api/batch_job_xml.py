@@ -0,0 +1,225 @@
+import logging
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+
+_XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+
+class _Uncompilable(Exception):
+    pass
+
+
+def _text(value):
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    return str(value)
+
+
+def _encode(text):
+    # googleads writes the operations with ElementTree as ASCII, anything else becomes a character reference
+    return escape(text).encode('ascii', 'xmlcharrefreplace')
+
+
+def get_shape(value):
+    """
+    Hashable structure of an operation: its fields without None values, the xsi_type of each dict, the shapes
+    of the items of each list and the type of each value
+
+    >>> get_shape({'xsi_type': 'Money', 'microAmount': 10, 'currencyCode': None})
+    (('xsi_type', 'Money'), ('microAmount', <class 'int'>))
+    """
+    if isinstance(value, dict):
+        return tuple((key, item if key == 'xsi_type' else get_shape(item))
+                     for key, item in value.items() if item is not None)
+    if isinstance(value, (list, tuple)):
+        return frozenset(get_shape(item) for item in value)
+    # an empty value is written as an empty element
+    return '' if value == '' else type(value)
+
+
+def schemaless_operations_xml(operations):
+    """
+    XML of a list of operations written without the AdWords schema, usable as the `reference` of a
+    `BatchJobXmlSerializer` when the API (and its WSDL) is not at hand. The fields keep the order of the
+    dicts and the `.Type` elements googleads adds are missing, so the output is a few bytes shorter than
+    the uploaded one, but otherwise escaped and encoded the same way.
+
+    >>> schemaless_operations_xml([{'operator': 'SET', 'operand': {'microAmount': 10}}])
+    '<operations><operator>SET</operator><operand><microAmount>10</microAmount></operand></operations>'
+    """
+    def fill(element, value):
+        for key, item in value.items():
+            if key == 'xsi_type':
+                element.set(_XSI_TYPE, item)
+                continue
+            for list_item in (item if isinstance(item, (list, tuple)) else [item]):
+                if list_item is None:
+                    continue
+                child = ElementTree.SubElement(element, key)
+                if isinstance(list_item, dict):
+                    fill(child, list_item)
+                else:
+                    child.text = _text(list_item)
+
+    xml = ''
+    for operation in operations:
+        element = ElementTree.Element('operations')
+        fill(element, operation)
+        xml += ElementTree.tostring(element).decode('ascii')
+    return xml
+
+
+def _start_tag(element):
+    if element.tag.startswith('{'):
+        raise _Uncompilable('namespaced element {}'.format(element.tag))
+    start = '<' + element.tag
+    for name, value in element.attrib.items():
+        if name != _XSI_TYPE:
+            raise _Uncompilable('attribute {} of {}'.format(name, element.tag))
+        start += ' xsi:type="' + escape(value, {'"': '&quot;'}) + '"'
+    return start
+
+
+def _compile_constant(element):
+    text = element.text or ''
+    if text:
+        return _start_tag(element).encode('ascii') + b'>' + _encode(text) + '</{}>'.format(element.tag).encode('ascii')
+    return _start_tag(element).encode('ascii') + b' />'
+
+
+def _compile_element(element, value):
+    start = _start_tag(element)
+    open_tag, close_tag, empty_tag = (start + '>').encode('ascii'), '</{}>'.format(element.tag).encode('ascii'), \
+        (start + ' />').encode('ascii')
+    if isinstance(value, dict):
+        if (element.text or '').strip():
+            raise _Uncompilable('text in {}'.format(element.tag))
+        return open_tag, close_tag, empty_tag, _compile_children(element, value)
+    if len(element) or _text(value) != (element.text or ''):
+        raise _Uncompilable('value of {}'.format(element.tag))
+    return open_tag, close_tag, empty_tag, None
+
+
+def _compile_children(element, value):
+    """
+    Steps writing the children of an element in the order of the reference XML: (field, element) for a
+    field, (field, {shape: element}) for the items of a list field and (None, bytes) for a constant element,
+    like the `.Type` elements googleads adds
+    """
+    children = list(element)
+    steps = []
+    seen = set()
+    index = 0
+    while index < len(children):
+        child = children[index]
+        item = value.get(child.tag) if child.tag != 'xsi_type' else None
+        if item is None:
+            if not child.tag.endswith('.Type') or len(child):
+                raise _Uncompilable('unknown element {}'.format(child.tag))
+            steps.append((None, _compile_constant(child)))
+            index += 1
+            continue
+        seen.add(child.tag)
+        if isinstance(item, (list, tuple)):
+            items = {}
+            for list_item in item:
+                if index >= len(children) or children[index].tag != child.tag:
+                    raise _Uncompilable('items of {}'.format(child.tag))
+                items[get_shape(list_item)] = _compile_element(children[index], list_item)
+                index += 1
+            steps.append((child.tag, items))
+        else:
+            steps.append((child.tag, _compile_element(child, item)))
+            index += 1
+    missing = [key for key, item in value.items()
+               if key != 'xsi_type' and key not in seen and item is not None and item != []]
+    if missing:
+        raise _Uncompilable('fields {} not written'.format(missing))
+    return tuple(steps)
+
+
+def _write(compiled, value, buffer):
+    open_tag, close_tag, empty_tag, body = compiled
+    if body is None:
+        text = _text(value)
+        if text:
+            buffer += open_tag
+            buffer += _encode(text)
+            buffer += close_tag
+        else:
+            buffer += empty_tag
+    elif body:
+        buffer += open_tag
+        for key, step in body:
+            if key is None:
+                buffer += step
+            elif isinstance(step, dict):
+                for item in value[key]:
+                    _write(step[get_shape(item)], item, buffer)
+            else:
+                _write(step, value[key], buffer)
+        buffer += close_tag
+    else:
+        buffer += empty_tag
+
+
+class BatchJobXmlSerializer:
+    """
+    Writes the XML of batch job operations straight into bytes, with the same output as googleads
+
+    The first operation of each shape (see `get_shape`) goes through the `reference` serializer, a function
+    of a list of operations of one type returning their XML, like the `_GenerateOperationsXML` of the
+    googleads request builder. Its output gives the element order, the `.Type` elements and the xsi:type
+    attributes of the shape, which are compiled into a template of byte strings, and the next operations of
+    that shape are written from the template without going through SOAP. A template is only kept if it
+    writes the operation it was compiled from exactly like the reference, the shapes without one (and the
+    operations the reference rejects) keep using the reference.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.fallbacks = 0
+
+    def compile(self, operation, reference):
+        """
+        Returns the template of the shape of the operation (None if it can not be compiled) and its XML
+        """
+        xml = reference([operation])
+        try:
+            root = ElementTree.fromstring(xml)
+            body = _compile_children(root, operation)
+            if not body:
+                raise _Uncompilable('empty operation')
+            template = (xml[:xml.index('>') + 1].encode('utf-8'), '</{}>'.format(root.tag).encode('ascii'), None,
+                        body)
+            buffer = bytearray()
+            _write(template, operation, buffer)
+            if bytes(buffer) != xml.encode('utf-8'):
+                raise _Uncompilable('output differs from the reference')
+        except (_Uncompilable, ElementTree.ParseError) as e:
+            logger.warning('No template for %s operations, using the reference serializer: %s',
+                           operation.get('xsi_type'), e)
+            template = None
+        return template, xml
+
+    def serialize(self, operations, reference):
+        """
+        XML (as UTF-8 bytes) of one or more lists of operations, as `_BuildUploadRequestBody` writes them
+        without the prefix and the suffix
+        """
+        buffer = bytearray()
+        for operations_of_type in operations:
+            for operation in operations_of_type:
+                shape = get_shape(operation)
+                if shape not in self.templates:
+                    self.templates[shape], xml = self.compile(operation, reference)
+                    buffer += xml.encode('utf-8')
+                elif self.templates[shape] is None:
+                    self.fallbacks += 1
+                    buffer += reference([operation]).encode('utf-8')
+                else:
+                    _write(self.templates[shape], operation, buffer)
+        return bytes(buffer)
@@ -1,8 +1,13 @@
 import requests
 import logging
+import random
+import socket
 from functools import lru_cache
+from http.client import HTTPException
 import time
 
+import googleads.errors
+
 logger = logging.getLogger(__name__)
 
 API_VERSION = 'v201809'
@@ -42,6 +47,133 @@ def get_report_csv(report_type):
     return requests.get(csv_url).content.decode('utf-8')
 
 
+# kinds of errors of RetryPolicy.classify
+TRANSIENT = 'transient'
+RATE_LIMIT = 'rate_limit'
+FATAL = 'fatal'
+
+# ApiError.errorString prefixes of the errors worth a retry
+# https://developers.google.com/adwords/api/docs/guides/error-handling
+TRANSIENT_API_ERRORS = ('InternalApiError.', 'DatabaseError.CONCURRENT_MODIFICATION',
+                        'ReportDownloadError.ERROR_GETTING_RESPONSE_FROM_BACKEND')
+RATE_LIMIT_API_ERRORS = ('RateExceededError.',)
+
+
+def _get_field(obj, name):
+    # zeep objects, dicts and exceptions
+    value = getattr(obj, name, None)
+    if value is None and isinstance(obj, dict):
+        value = obj.get(name)
+    return value
+
+
+def _get_status_code(error):
+    for obj in (error, _get_field(error, 'response'), _get_field(error, 'error')):
+        for name in ('code', 'status_code', 'status'):
+            value = _get_field(obj, name) if obj is not None else None
+            if isinstance(value, int) and 100 <= value < 600:
+                return value
+    return None
+
+
+def _get_api_errors(error):
+    if isinstance(error, googleads.errors.GoogleAdsServerFault):
+        return [str(_get_field(api_error, 'errorString') or '') for api_error in error.errors or ()]
+    if isinstance(error, googleads.errors.AdWordsReportBadRequestError):
+        return [str(error.type or '')]
+    return []
+
+
+class RetryPolicy:
+    """
+    Calls a function again when it fails with an error worth a retry, waiting longer after each failure
+
+    `classify` sorts the errors: rate limits (HTTP 429 or a RateExceededError) and transient errors (server
+    side HTTP errors, internal API errors, concurrent modifications and network failures) are retried up to
+    `max_retries` times, anything else is raised at once. The wait doubles from `base_delay` on each retry
+    (from `rate_limit_delay` for rate limits) up to `max_delay`, a random part of up to `jitter` of it is
+    taken off so concurrent clients do not retry together, and a delay asked by the server (the
+    retryAfterSeconds of the error or a Retry-After header) is always honored.
+    """
+    def __init__(self, max_retries=3, base_delay=1.0, rate_limit_delay=30.0, max_delay=300.0, jitter=0.5,
+                 sleep=time.sleep):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.rate_limit_delay = rate_limit_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.sleep = sleep
+
+    def classify(self, error):
+        api_errors = _get_api_errors(error)
+        if any(api_error.startswith(RATE_LIMIT_API_ERRORS) for api_error in api_errors):
+            return RATE_LIMIT
+        if any(api_error.startswith(TRANSIENT_API_ERRORS) for api_error in api_errors):
+            return TRANSIENT
+        if isinstance(error, googleads.errors.GoogleAdsServerFault):
+            # faults without API errors come from the SOAP layer
+            return FATAL if api_errors else TRANSIENT
+        status_code = _get_status_code(error)
+        if status_code is not None:
+            if status_code == 429:
+                return RATE_LIMIT
+            if status_code >= 500 or status_code == 408:
+                return TRANSIENT
+            return FATAL
+        if isinstance(error, (ConnectionError, socket.timeout, HTTPException, requests.ConnectionError,
+                              requests.Timeout, googleads.errors.GoogleAdsSoapTransportError)):
+            return TRANSIENT
+        return FATAL
+
+    def get_retry_after(self, error):
+        """
+        Seconds the server asked to wait before retrying, or None
+        """
+        if isinstance(error, googleads.errors.GoogleAdsServerFault):
+            delays = [_get_field(api_error, 'retryAfterSeconds') for api_error in error.errors or ()]
+            delays = [int(delay) for delay in delays if delay]
+            if delays:
+                return max(delays)
+        for obj in (error, _get_field(error, 'response'), _get_field(error, 'error')):
+            headers = _get_field(obj, 'headers') if obj is not None else None
+            value = headers.get('Retry-After') if headers is not None else None
+            if value is not None and str(value).strip().isdigit():
+                return int(value)
+        return None
+
+    def get_delay(self, retry, error, kind=None):
+        """
+        Seconds to wait before the `retry`-th retry (from 0) after `error`
+        """
+        kind = kind or self.classify(error)
+        base_delay = self.rate_limit_delay if kind == RATE_LIMIT else self.base_delay
+        delay = min(self.max_delay, base_delay * 2 ** retry)
+        delay -= delay * self.jitter * random.random()
+        retry_after = self.get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        retry = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                kind = self.classify(e)
+                if kind == FATAL or retry >= self.max_retries:
+                    logger.error('Giving up after %s retries on %s error: %s', retry, kind, e)
+                    raise
+                delay = self.get_delay(retry, e, kind)
+                retry += 1
+                logger.warning('Retry %s of %s in %.1f seconds after %s error: %s',
+                               retry, self.max_retries, delay, kind, e)
+                self.sleep(delay)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
 class BaseResult:
     def __init__(self, callback, parameters):
         self.callback = callback
@@ -58,8 +190,9 @@ class BaseResult:
 
 
 class SyncReturnValue(BaseResult):
-    def __init__(self, callback, parameters):
+    def __init__(self, callback, parameters, retry_policy=None):
         super().__init__(callback, parameters)
+        self.retry_policy = retry_policy or DEFAULT_RETRY_POLICY
         label_operations = [adw_op for adw_op in parameters if 'labelId' in adw_op['operand']]
         regular_operations = [adw_op for adw_op in parameters if 'labelId' not in adw_op['operand']]
 
@@ -71,21 +204,7 @@ class SyncReturnValue(BaseResult):
             self.operations_sent = regular_operations
 
     def _upload_sync_operations(self, callback, operations):
-        fail_counter = 0
-        done = False
-        while not done:
-            try:
-                results = callback(operations)
-                done = True
-                return results
-            except Exception as e:
-                fail_counter += 1
-                time.sleep(fail_counter*60)
-                if fail_counter > 3:
-                    logger.error('Problem sync uploading the data, failure...')
-                    raise e
-                logger.error('Problem sync uploading the data, retrying for the %s time...', fail_counter)
-                logger.error(str(e))
+        return self.retry_policy.call(callback, operations)
 
     def get_errors(self):
         if self.result and 'partialFailureErrors' in self.result:
@@ -142,6 +261,7 @@ class BaseService:
         self._service = None
         self.helper = None
         self.ResultProcessor = None
+        self.retry_policy = DEFAULT_RETRY_POLICY
 
     @property
     def service(self):
@@ -171,7 +291,7 @@ class BaseService:
         if client_customer_id:
             self.client.SetClientCustomerId(client_customer_id)
         if sync:
-            return self.ResultProcessor(self.service, self.helper.operations)
+            return self.ResultProcessor(self.service, self.helper.operations, self.retry_policy)
         return self.ResultProcessor(self.service.mutate, self.helper.operations)
 
 
@@ -32,6 +32,25 @@ def adgroup_operation(campaign_id: 'Long' = None,
     return operation
 
 
+def adgroup_bid_operation(adgroup_id: 'Long' = None,
+                          cpc_bid: 'Bid' = None,
+                          **kwargs):
+    """
+    Same as a SET `adgroup_operation` with only the cpc_bid, without the intermediate internal operation
+    """
+    bidding_strategy = _build_new_bidding_strategy_configuration()
+    bidding_strategy['bids'].append(_build_new_bid_type('CpcBid', cpc_bid))
+    return {
+        'xsi_type': 'AdGroupOperation',
+        'operand': {
+            'xsi_type': 'AdGroup',
+            'id': adgroup_id,
+            'biddingStrategyConfiguration': bidding_strategy,
+        },
+        'operator': 'SET',
+    }
+
+
 def ad_group_label_operation(operator: 'String' = 'ADD',
                              ad_group_id: 'Long' = None,
                              label_id: 'Long' = None,
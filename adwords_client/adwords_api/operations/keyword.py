@@ -42,6 +42,27 @@ def new_keyword_operation(adgroup_id: 'Long' = None,
     return operation
 
 
+def keyword_bid_operation(adgroup_id: 'Long' = None,
+                          criteria_id: 'Long' = None,
+                          cpc_bid: 'Bid' = None,
+                          **kwargs):
+    """
+    Same as a SET `new_keyword_operation` with only the cpc_bid, without the intermediate internal operation
+    """
+    bidding_strategy = _build_new_bidding_strategy_configuration()
+    bidding_strategy['bids'].append(_build_new_bid_type('CpcBid', cpc_bid))
+    return {
+        'xsi_type': 'AdGroupCriterionOperation',
+        'operand': {
+            'xsi_type': 'BiddableAdGroupCriterion',
+            'criterion': {'xsi_type': 'Keyword', 'id': criteria_id},
+            'adGroupId': adgroup_id,
+            'biddingStrategyConfiguration': bidding_strategy,
+        },
+        'operator': 'SET'
+    }
+
+
 def get_keyword_operation(fields=[], predicates=[], **kwargs):
     default_fields = kwargs.pop('default_fields', False)
     if default_fields:
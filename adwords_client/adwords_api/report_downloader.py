@@ -1,6 +1,6 @@
 import logging
 
-from .common import API_VERSION
+from .common import API_VERSION, DEFAULT_RETRY_POLICY
 
 logger = logging.getLogger(__name__)
 
@@ -9,6 +9,7 @@ class ReportDownloader:
     def __init__(self, client):
         self.client = client
         self.downloader = None
+        self.retry_policy = DEFAULT_RETRY_POLICY
         self.get_downloader()
 
     def get_downloader(self):
@@ -33,4 +34,4 @@ class ReportDownloader:
         for key in kwargs:
             if key in report_params:
                 report_params[key] = kwargs[key]
-        return self.downloader.DownloadReportAsStreamWithAwql(**report_params)
+        return self.retry_policy.call(self.downloader.DownloadReportAsStreamWithAwql, **report_params)
@@ -0,0 +1,413 @@
+import hashlib
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+from os import path
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+
+from . import storages, utils
+
+logger = logging.getLogger(__name__)
+
+
+class OperationsBuffer:
+    """
+    Buffer of internal operations backed by a temporary file, optionally compressed
+    """
+    def __init__(self, serializer, compression=None):
+        self.serializer = serializer
+        self.compression = compression
+        self.rows = 0
+        # lowest id written to the buffer, kept up to date by the client
+        self.min_id = 0
+        self._file = None
+        self._writer = None
+
+    @property
+    def current(self):
+        """
+        Buffer that receives the writes of the calling thread
+        """
+        return self
+
+    @property
+    def file(self):
+        if not self._file:
+            self._file = self.open()
+        return self._file
+
+    def open(self):
+        file = NamedTemporaryFile('w+b')
+        logger.debug('Created temporary buffer file %s', file.name)
+        return file
+
+    @property
+    def writer(self):
+        if not self._writer:
+            if self.compression:
+                # a new compressed member goes after everything written before
+                self.file.seek(0, io.SEEK_END)
+                self._writer = utils.compression_stream(self.file, self.compression, 'wb')
+            else:
+                self._writer = self.file
+        return self._writer
+
+    def write(self, entry):
+        self.serializer.dump(entry, self.writer)
+        self.rows += 1
+
+    def write_many(self, entries):
+        dumps = self.serializer.dumps
+        data = [dumps(entry) for entry in entries]
+        self.writer.write(b''.join(data))
+        self.rows += len(data)
+
+    def _close_writer(self):
+        if self.compression and self._writer:
+            self._writer.close()
+        self._writer = None
+
+    def read(self):
+        self._close_writer()
+        self.file.flush()
+        # an empty file is not a valid xz stream
+        if self.compression and not self.file.seek(0, io.SEEK_END):
+            return
+        self.file.seek(0)
+        if self.compression:
+            yield from self.serializer.load(utils.compression_stream(self.file, self.compression, 'rb'))
+        else:
+            yield from self.serializer.load(self.file)
+
+    def ranges(self, count):
+        """
+        Divides the buffer file into up to `count` (file name, start, end) byte ranges ending at line
+        boundaries, so other processes can read it in parallel. Returns None when the buffer can not be read
+        that way: compressed, not line based or not kept in a named file.
+        """
+        if self.compression or not getattr(self.serializer, 'line_based', False):
+            return None
+        self._close_writer()
+        file = self.file
+        if not isinstance(getattr(file, 'name', None), str):
+            return None
+        file.flush()
+        size = file.seek(0, io.SEEK_END)
+        ranges = []
+        start = 0
+        for index in range(1, count + 1):
+            end = size * index // count
+            if start < end < size:
+                file.seek(end)
+                file.readline()
+                end = file.tell()
+            if end > start:
+                ranges.append((file.name, start, end))
+                start = end
+        return ranges
+
+    def close(self):
+        self._close_writer()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        self.close()
+
+
+class SpooledBuffer(OperationsBuffer):
+    """
+    Keeps the operations in memory until the buffer grows over `max_size` bytes or `max_rows` rows,
+    then spills everything to a temporary file and keeps writing there
+    """
+    def __init__(self, serializer, compression=None, max_size=None, max_rows=None):
+        super().__init__(serializer, compression)
+        self.max_size = max_size
+        self.max_rows = max_rows
+
+    def open(self):
+        # a max_size of 0 means that only the rows budget triggers the spill
+        return SpooledTemporaryFile(max_size=self.max_size or 0, mode='w+b')
+
+    @property
+    def spilled(self):
+        return bool(self._file and self._file._rolled)
+
+    def write(self, entry):
+        super().write(entry)
+        self._check_rows()
+
+    def write_many(self, entries):
+        super().write_many(entries)
+        self._check_rows()
+
+    def _check_rows(self):
+        if self.max_rows and self.rows > self.max_rows and not self.spilled:
+            logger.debug('Buffer over %s rows, spilling it to disk', self.max_rows)
+            self._file.rollover()
+
+
+class DurableBuffer(OperationsBuffer):
+    """
+    Operations buffer kept on the storage, that survives the process that wrote it
+
+    Entries go to segment files under `name`. Every `commit_every` rows the current segment is finished and
+    a commit marker listing the finished segments is written, alternating between two marker files so a
+    crash while writing one of them still leaves the previous commit readable. Opening a buffer with the
+    same name again resumes from the last commit, rows written after it are lost.
+    """
+    def __init__(self, storage, name, serializer, compression=None, commit_every=100000):
+        super().__init__(serializer, compression)
+        self.storage = storage
+        self.name = name
+        self.commit_every = commit_every
+        self.segments = []
+        self.sequence = 0
+        self._segment = None
+        self._pending = 0
+        self._load()
+
+    def _marker_name(self, sequence):
+        return '{}/commit.{}'.format(self.name, sequence % 2)
+
+    def _load(self):
+        markers = []
+        for sequence in range(2):
+            marker_name = self._marker_name(sequence)
+            if self.storage.exists(marker_name):
+                with self.storage.open(marker_name, 'rb') as file:
+                    try:
+                        markers.append(json.loads(file.read().decode('utf-8')))
+                    except ValueError:
+                        logger.warning('Ignoring corrupted commit marker %s', marker_name)
+        if markers:
+            marker = max(markers, key=lambda item: item['sequence'])
+            if marker['serializer'] != self.serializer.name or marker['compression'] != self.compression:
+                raise ValueError('Buffer {} was written with serializer {} and compression {}'.format(
+                    self.name, marker['serializer'], marker['compression']))
+            self.sequence = marker['sequence']
+            self.segments = marker['segments']
+            self.rows = marker['rows']
+            self.min_id = marker['min_id']
+            logger.info('Reopened buffer %s with %s committed rows', self.name, self.rows)
+
+    def open(self):
+        # named after the commit that will include it, so a segment lost in a crash is just overwritten
+        self._segment = utils.compressed_name('{}/{:08d}.segment'.format(self.name, self.sequence + 1),
+                                              self.compression)
+        logger.debug('Created buffer segment %s', self._segment)
+        return self.storage.open(self._segment, 'wb')
+
+    def write(self, entry):
+        super().write(entry)
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def write_many(self, entries):
+        super().write_many(entries)
+        self._pending += len(entries)
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def _close_writer(self):
+        super()._close_writer()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write_marker(self):
+        marker = {
+            'sequence': self.sequence,
+            'segments': self.segments,
+            'rows': self.rows,
+            'min_id': self.min_id,
+            'serializer': self.serializer.name,
+            'compression': self.compression,
+        }
+        with self.storage.open(self._marker_name(self.sequence), 'wb') as file:
+            file.write(json.dumps(marker).encode('utf-8'))
+
+    def commit(self):
+        if not self._segment:
+            return
+        self._close_writer()
+        self.segments.append(self._segment)
+        self.sequence += 1
+        self._write_marker()
+        logger.debug('Committed buffer %s with %s rows', self.name, self.rows)
+        self._segment = None
+        self._pending = 0
+
+    def ranges(self, count):
+        # segments may live in a remote storage
+        return None
+
+    def read(self):
+        self.commit()
+        for segment in self.segments:
+            file = self.storage.open(segment, 'rb')
+            try:
+                if self.compression:
+                    yield from self.serializer.load(utils.compression_stream(file, self.compression, 'rb'))
+                else:
+                    yield from self.serializer.load(file)
+            finally:
+                file.close()
+
+    def close(self):
+        self.commit()
+
+    def discard(self):
+        self._close_writer()
+        for segment in self.segments + [self._segment]:
+            if segment:
+                self.storage.delete(segment)
+        self.segments = []
+        self.rows = 0
+        self.min_id = 0
+        self._segment = None
+        self._pending = 0
+        self.sequence += 1
+        self._write_marker()
+
+
+class PartitionedBuffer:
+    """
+    Writes every entry straight to its data file under `folder`, as `split` would, so the operations are
+    written only once
+
+    `partitioner(entry)` names the data file of each entry and at most `max_open_files` files are kept open
+    through a `utils.FilePool`. The manifest stats of the files are kept as they are written. Reading goes
+    through the data files in the order they were created, so entries come grouped by file.
+    """
+    def __init__(self, storage, folder, serializer, partitioner, compression=None, max_open_files=256):
+        self.storage = storage
+        self.folder = folder
+        self.serializer = serializer
+        self.partitioner = partitioner
+        self.compression = compression
+        self.rows = 0
+        self.min_id = 0
+        self.files = OrderedDict()
+        self.checksums = {}
+        self.pool = utils.FilePool(self._open_file, max_open_files, append=storages.is_local(storage))
+
+    @property
+    def current(self):
+        return self
+
+    def _open_file(self, name, mode):
+        return utils.open_storage_file(self.storage, path.join(self.folder, name), mode, self.compression)
+
+    def write(self, entry):
+        file_name = self.partitioner(entry)
+        data = self.serializer.dumps(entry)
+        self.pool.write(file_name, data)
+        utils.add_file_stats(self.files, file_name, entry, len(data))
+        checksum = self.checksums.get(file_name)
+        if checksum is None:
+            checksum = self.checksums[file_name] = hashlib.sha256()
+        checksum.update(data)
+        self.rows += 1
+
+    def write_many(self, entries):
+        for entry in entries:
+            self.write(entry)
+
+    def ranges(self, count):
+        return None
+
+    def manifest(self):
+        """
+        Finishes the pending writes and returns the manifest stats of the data files
+        """
+        self.pool.close()
+        files = OrderedDict()
+        for file_name, stats in self.files.items():
+            files[file_name] = dict(stats, checksum=self.checksums[file_name].hexdigest())
+        return files
+
+    def read(self):
+        self.pool.close()
+        for file_name in list(self.pool.created):
+            file = self._open_file(file_name, 'rb')
+            try:
+                yield from self.serializer.load(file)
+            finally:
+                file.close()
+
+    def close(self):
+        self.pool.close()
+
+    def discard(self):
+        self.pool.close()
+        for file_name in self.pool.created:
+            self.storage.delete(utils.compressed_name(path.join(self.folder, file_name), self.compression))
+        self.files = OrderedDict()
+        self.checksums = {}
+        self.pool = utils.FilePool(self._open_file, self.pool.max_open, self.pool.max_buffered,
+                                   self.pool.spool is None)
+        self.rows = 0
+
+
+class ThreadedBuffer:
+    """
+    Gives each writing thread its own sub-buffer, created by `factory(index)`, so threads never share a file
+
+    Reading goes through the sub-buffers in the order they were created. The first `reopened` sub-buffers
+    are created upfront, for factories that reopen existing (durable) buffers, and receive no new writes.
+    """
+    def __init__(self, factory, reopened=0):
+        self.factory = factory
+        self.buffers = [factory(index) for index in range(reopened)]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            with self._lock:
+                buffer = self.factory(len(self.buffers))
+                self.buffers.append(buffer)
+            self._local.buffer = buffer
+        return buffer
+
+    @property
+    def rows(self):
+        return sum(buffer.rows for buffer in self.buffers)
+
+    @property
+    def min_id(self):
+        return min([buffer.min_id for buffer in self.buffers] or [0])
+
+    def write(self, entry):
+        self.current.write(entry)
+
+    def write_many(self, entries):
+        self.current.write_many(entries)
+
+    def ranges(self, count):
+        ranges = []
+        for buffer in self.buffers:
+            buffer_ranges = buffer.ranges(count)
+            if buffer_ranges is None:
+                return None
+            ranges.extend(buffer_ranges)
+        return ranges
+
+    def read(self):
+        for buffer in list(self.buffers):
+            yield from buffer.read()
+
+    def close(self):
+        for buffer in self.buffers:
+            buffer.close()
+
+    def discard(self):
+        for buffer in self.buffers:
+            buffer.discard()
@@ -1,47 +1,82 @@
 import csv
 import datetime
+import hashlib
+import heapq
 import inspect
 import json
 import logging
 import time
 import uuid
 import yaml
-from collections import Mapping
-from threading import local
+import zlib
+from collections import Mapping, OrderedDict
+from threading import Lock, local
 from io import StringIO
 from math import floor, isfinite
 from multiprocessing import Pool
-from os import path
-from tempfile import NamedTemporaryFile
+from os import makedirs, path
+from tempfile import TemporaryDirectory
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import googleads.adwords
 
-from . import adwords_api, config, storages, utils
+from . import adwords_api, buffers, config, storages, utils
 from .adwords_api import common
+from .adwords_api.batch_job_service import UploadChunker, UploadPipeline
+from .adwords_api.batch_job_xml import BatchJobXmlSerializer, schemaless_operations_xml
 from .internal_api.builder import OperationsBuilder
-from .internal_api.mappers import MAPPERS
+from .internal_api.coalescer import OperationsCoalescer
+from .internal_api.packing import CampaignPacker, CampaignSharder, Partitioner
+from .internal_api.planner import MAX_DEPENDENCY_LEVEL, DependencyPlanner, get_dependency_level, make_sort_key
+from .adwords_api.operations import adgroup, keyword
+from .internal_api.mappers import MAPPERS, cents_as_money, get_id_fields, get_text_parser
+from .internal_api.records import make_record
+from .internal_api.serializers import get_serializer
 
 logger = logging.getLogger(__name__)
 
+# number of operations sent on each upload of a batch job
+BATCH_SIZE = 5000
 
-def _iter_floats(data):
-    for item in data:
-        try:
-            if item and isfinite(item):
-                yield float(item)
-        except (TypeError, ValueError):
-            pass
+# number of operations sent on each sync mutate request
+SYNC_BATCH_SIZE = 1000
+
+# file written by split, describing the data files of an operations folder
+MANIFEST_NAME = 'manifest.json'
+
+# guards the lazy creation of the operations buffers, so concurrent first inserts end up in the same buffer
+_buffer_lock = Lock()
+
+# guards the writes to `.result` files, which the upload pipeline threads also write checkpoints to
+_checkpoint_lock = Lock()
+
+
+def _split_range(args):
+    """
+    Partitions a byte range of a line based buffer file into local part files under `parts_folder`, one
+    per data file. Kept at module level so it can be sent to the processes of the map_function.
+    """
+    buffer_name, start, end, serializer, parts_folder, partitioner, max_open_files = args
 
+    def open_part(name, mode):
+        makedirs(path.dirname(path.join(parts_folder, name)), exist_ok=True)
+        return open(path.join(parts_folder, name), mode)
 
-def _get_dict_min_value(data):
+    files = OrderedDict()
+    pool = utils.FilePool(open_part, max_open_files)
     try:
-        return min(int(floor(u)) for u in _iter_floats(data.values()))
-    except ValueError:
-        logger.debug('Problem getting min value for: %s', str(data))
-        for k, v in data.items():
-            logger.debug('Key: %s (%s) Value: %s (%s)', str(k), str(type(k)), str(v), str(type(v)))
-        raise
+        with open(buffer_name, 'rb') as buffer_file:
+            buffer_file.seek(start)
+            for line in utils.read_lines(buffer_file, end - start):
+                entry = serializer.loads(line)
+                file_name = partitioner(entry)
+                # the line is already serialized with the same serializer
+                pool.write(file_name, line)
+                utils.add_file_stats(files, file_name, entry, len(line))
+    finally:
+        pool.close()
+    return files
 
 
 def adwords_client_factory(credentials):
@@ -55,8 +90,48 @@ def multiprocessing_map(*args, **kwargs):
 
 
 class AdWords:
-    def __init__(self, workdir=None, storage=None, map_function=None, **kwargs):
+    def __init__(self, workdir=None, storage=None, map_function=None, serializer='json',
+                 buffer_max_size=None, buffer_max_rows=None, compression=None,
+                 buffer_name=None, buffer_commit_every=100000, concurrent_insert=False, partition_by=None,
+                 max_open_files=256, upload_queue_size=None, upload_chunk_bytes=None, upload_max_chunk_bytes=None,
+                 retry_policy=None, upload_serializer='googleads', **kwargs):
         self.map_function = map_function or multiprocessing_map
+        if serializer == 'auto' and buffer_name:
+            raise ValueError('A durable buffer can be reopened on another host, it needs a serializer other than auto')
+        self.serializer = get_serializer(serializer)
+        # the serializer of `auto` depends on the host, the folders written by others are read with theirs
+        self.auto_serializer = serializer == 'auto'
+        if compression and compression not in utils.COMPRESSION_SUFFIXES:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        # applies to the operations buffer and to every file written to the storage
+        self.compression = compression
+        # when any of these is set, the operations are kept in memory until the budget is exceeded
+        self.buffer_max_size = buffer_max_size
+        self.buffer_max_rows = buffer_max_rows
+        # when set, the operations are kept in the storage and can be reopened by a new instance
+        self.buffer_name = buffer_name
+        self.buffer_commit_every = buffer_commit_every
+        # gives each inserting thread its own sub-buffer, merged back when the buffer is read
+        self.concurrent_insert = concurrent_insert
+        # when set, inserted operations go straight to their data file (by 'campaign' or by 'client')
+        if partition_by not in (None, 'campaign', 'client'):
+            raise ValueError('Unknown partition_by: {}'.format(partition_by))
+        if partition_by and (buffer_name or concurrent_insert):
+            raise ValueError('partition_by can not be used with buffer_name or concurrent_insert')
+        self.partition_by = partition_by
+        self.max_open_files = max_open_files
+        # when set, batch job chunks are uploaded on a background thread, with at most this many waiting
+        self.upload_queue_size = upload_queue_size
+        # when set, batch job chunks are cut by estimated size instead of every BATCH_SIZE operations,
+        # adapting the size between the target and the upper bound to the latency of the uploads
+        self.upload_chunk_bytes = upload_chunk_bytes
+        self.upload_max_chunk_bytes = upload_max_chunk_bytes
+        # retries of the batch job uploads, the sync operations and the report downloads
+        self.retry_policy = retry_policy or common.RetryPolicy()
+        # 'precompiled' writes the batch job XML from templates compiled from the googleads output
+        if upload_serializer not in ('googleads', 'precompiled'):
+            raise ValueError('Unknown upload_serializer: {}'.format(upload_serializer))
+        self.xml_serializer = BatchJobXmlSerializer() if upload_serializer == 'precompiled' else None
         if storage:
             self.storage = storage
         else:
@@ -67,7 +142,7 @@ class AdWords:
 
     def _reset(self):
         self._local = None
-        self._operations_buffer = None
+        self._drop_buffer()
         # If this is a django storage, we want to reset the storage and lazy object before fork
         if hasattr(self.storage, '_wrapped'):
             # resets the wrapped object in the LazyObject
@@ -90,13 +165,55 @@ class AdWords:
             self.local.client = adwords_client_factory(client_settings)
         return self.local.client
 
+    @property
+    def min_id(self):
+        if self._operations_buffer:
+            return min(self._min_id, self._operations_buffer.min_id)
+        return self._min_id
+
+    @min_id.setter
+    def min_id(self, value):
+        self._min_id = value
+
+    def _new_buffer(self, index=None):
+        if self.partition_by:
+            partitioner = Partitioner(by_client=self.partition_by == 'client')
+            return buffers.PartitionedBuffer(self.storage, str(uuid.uuid1()), self.serializer, partitioner,
+                                             self.compression, self.max_open_files)
+        elif self.buffer_name:
+            name = self.buffer_name if index is None else path.join(self.buffer_name, str(index))
+            return buffers.DurableBuffer(self.storage, name, self.serializer, self.compression,
+                                         self.buffer_commit_every)
+        elif self.buffer_max_size or self.buffer_max_rows:
+            return buffers.SpooledBuffer(self.serializer, self.compression, self.buffer_max_size, self.buffer_max_rows)
+        return buffers.OperationsBuffer(self.serializer, self.compression)
+
     @property
     def operations(self):
         if not self._operations_buffer:
-            self._operations_buffer = NamedTemporaryFile('w+')
-            logger.debug('Created temporary buffer file %s', self._operations_buffer.name)
+            with _buffer_lock:
+                if not self._operations_buffer:
+                    if self.concurrent_insert:
+                        reopened = 0
+                        if self.buffer_name:
+                            folders, _ = self.storage.listdir(self.buffer_name)
+                            reopened = len([folder for folder in folders if folder.isdigit()])
+                        self._operations_buffer = buffers.ThreadedBuffer(self._new_buffer, reopened)
+                    else:
+                        self._operations_buffer = self._new_buffer()
         return self._operations_buffer
 
+    def _drop_buffer(self, discard=False):
+        buffer = getattr(self, '_operations_buffer', None)
+        if buffer:
+            # keeps the ids seen so far, they are still needed to build the operations
+            self._min_id = min(self._min_id, buffer.min_id)
+            if discard:
+                buffer.discard()
+            else:
+                buffer.close()
+        self._operations_buffer = None
+
     @property
     def services(self):
         if not getattr(self.local, 'services', None):
@@ -111,12 +228,17 @@ class AdWords:
 
     def service(self, service_name):
         if service_name not in self.services:
-            self.services[service_name] = getattr(adwords_api, service_name)(self.client)
+            service = getattr(adwords_api, service_name)(self.client)
+            service.retry_policy = self.retry_policy
+            self.services[service_name] = service
         return self.services[service_name]
 
-    def get_file(self, name, *args, **kwargs):
+    def _open_file(self, name, mode='r'):
+        return utils.open_storage_file(self.storage, name, mode, self.compression)
+
+    def get_file(self, name, mode='r'):
         if name not in self.open_files:
-            self.open_files[name] = self.storage.open(name, *args, **kwargs)
+            self.open_files[name] = self._open_file(name, mode)
         return self.open_files[name]
 
     def flush_files(self):
@@ -126,43 +248,204 @@ class AdWords:
             file.close()
 
     def _write_entry(self, file_name, entry):
-        self.get_file(file_name, mode='w+').write(json.dumps(entry) + '\n')
+        self.serializer.dump(entry, self.get_file(file_name, mode='w+b'))
 
     def _read_entries(self, file_name):
-        file = self.get_file(file_name, mode='r')
+        if self.compression and file_name in self.open_files:
+            # a compressing stream can not be read back, so it must be finished first
+            self.open_files.pop(file_name).close()
+        file = self.get_file(file_name, mode='rb')
         file.flush()
         file.seek(0)
-        for line in file:
-            yield json.loads(line)
+        yield from self.serializer.load(file)
+
+    def _read_and_close(self, file_name):
+        """
+        Entries of a file that is not read again, closing it once they are read or when the reading stops
+        """
+        try:
+            yield from self._read_entries(file_name)
+        finally:
+            file = self.open_files.pop(file_name, None)
+            if file is not None:
+                file.close()
 
     def _read_from_folder(self, folder_name, name_filter=None):
         _, files = self.storage.listdir(folder_name)
         for file in files:
+            file = utils.uncompressed_name(file)
+            if file == MANIFEST_NAME:
+                continue
             if not name_filter or name_filter(file):
-                yield from self._read_entries(path.join(folder_name, file))
+                yield from self._read_and_close(path.join(folder_name, file))
 
     def _write_buffer(self, entry):
-        self.operations.write(json.dumps(entry) + '\n')
+        self.operations.write(entry)
 
     def _read_buffer(self):
-        self.operations.flush()
-        self.operations.seek(0)
-        for line in self.operations:
-            yield json.loads(line)
+        yield from self.operations.read()
 
     def _get_min_id(self, entry):
-        self.min_id = min(self.min_id, _get_dict_min_value(entry))
+        buffer = self.operations.current
+        min_id = buffer.min_id
+        for field in get_id_fields(entry.get('object_type')):
+            value = entry.get(field)
+            if value.__class__ is int:
+                if value < min_id:
+                    min_id = value
+            elif value.__class__ is float and isfinite(value) and value < min_id:
+                min_id = int(floor(value))
+        if min_id < buffer.min_id:
+            buffer.min_id = min_id
         return entry
 
+    def _check_entry(self, entry):
+        if 'client_id' not in entry:
+            raise ValueError('Every entry must have a "client_id" field.')
+        return self._get_min_id(entry)
+
     def insert(self, data):
         if isinstance(data, Mapping):
-            data = [self._get_min_id(data)]
-        else:
-            data = (self._get_min_id(entry) for entry in data)
+            data = [data]
         for entry in data:
-            if 'client_id' not in entry:
-                raise ValueError('Every entry must have a "client_id" field.')
-            self._write_buffer(entry)
+            self._write_buffer(self._check_entry(entry))
+
+    def _iter_csv(self, stream, defaults=None, **kwargs):
+        reader = csv.reader(stream, **kwargs)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return
+        defaults = defaults or {}
+        object_type_column = header.index('object_type') if 'object_type' in header else None
+        # resolve the parsers of the columns once per object_type, instead of once per value
+        parsers = {}
+        for row in reader:
+            object_type = defaults.get('object_type')
+            if object_type_column is not None and object_type_column < len(row) and row[object_type_column]:
+                object_type = row[object_type_column]
+            columns = parsers.get(object_type)
+            if columns is None:
+                columns = parsers[object_type] = list(zip(header, [get_text_parser(name, object_type)
+                                                                   for name in header]))
+            entry = dict(defaults)
+            for (name, parser), value in zip(columns, row):
+                if value != '':
+                    try:
+                        entry[name] = parser(value)
+                    except ValueError as e:
+                        raise ValueError('Invalid value {!r} for column {} at line {}: {}'.format(
+                            value, name, reader.line_num, e)) from e
+            yield entry
+
+    def _iter_jsonl(self, stream, defaults=None):
+        defaults = defaults or {}
+        for line in stream:
+            if line.strip():
+                entry = dict(defaults)
+                entry.update(json.loads(line))
+                yield entry
+
+    def insert_file(self, file, file_format=None, chunk_size=10000, defaults=None, **kwargs):
+        """
+        Insert every operation from a CSV (with a header row) or JSON lines file, given as a path or as a
+        text stream. `defaults` are used for the fields missing in the file (eg.: `object_type`) and the
+        remaining keyword arguments are passed to the `csv.reader`. Returns the number of inserted entries.
+        """
+        if isinstance(file, str):
+            if not file_format:
+                file_format = 'jsonl' if file.endswith(('.jsonl', '.json')) else 'csv'
+            with open(file, newline='') as stream:
+                return self.insert_file(stream, file_format, chunk_size, defaults, **kwargs)
+        if file_format == 'jsonl':
+            entries = self._iter_jsonl(file, defaults)
+        elif file_format in (None, 'csv'):
+            entries = self._iter_csv(file, defaults, **kwargs)
+        else:
+            raise ValueError('Unknown file format: {}'.format(file_format))
+        inserted = 0
+        for chunk in utils.chunks(entries, chunk_size):
+            self.operations.write_many([self._check_entry(entry) for entry in chunk])
+            inserted += len(chunk)
+        logger.info('Inserted %s entries from file', inserted)
+        return inserted
+
+    def insert_csv(self, file, chunk_size=10000, defaults=None, **kwargs):
+        return self.insert_file(file, 'csv', chunk_size, defaults, **kwargs)
+
+    def coalesce(self):
+        """
+        Rewrites the operations buffer merging the operations on the same entity into a single one,
+        see `OperationsCoalescer`. Returns the number of operations removed from the buffer.
+        """
+        logger.info('Running %s...', inspect.stack()[0][3])
+        coalescer = OperationsCoalescer()
+        try:
+            for entry in self._read_buffer():
+                coalescer.add(entry)
+            self._drop_buffer(discard=True)
+            for chunk in utils.chunks(coalescer, 10000):
+                self.operations.write_many(chunk)
+        finally:
+            coalescer.close()
+        logger.info('Coalesced %s operations into %s', coalescer.received, coalescer.received - coalescer.dropped)
+        return coalescer.dropped
+
+    def resolve_dependencies(self):
+        """
+        Rewrites the operations buffer in dependency order (campaigns and budgets, then ad groups and campaign
+        criteria, then keywords and ads, see `DEPENDENCY_LEVELS`), keeping the buffer order inside each level,
+        and drops the operations made redundant by the REMOVE of their campaign or ad group wherever it is in
+        the buffer, along with the ADD and the REMOVE of the campaigns and ad groups that are added and removed
+        (see `DependencyPlanner`). Returns the number of dropped operations.
+        """
+        logger.info('Running %s...', inspect.stack()[0][3])
+        planner = DependencyPlanner()
+        for entry in self._read_buffer():
+            planner.add(entry)
+        levels = [buffers.OperationsBuffer(self.serializer) for _ in range(MAX_DEPENDENCY_LEVEL + 1)]
+        try:
+            for entry in self._read_buffer():
+                if not planner.is_redundant(entry):
+                    levels[get_dependency_level(entry.get('object_type'))].write(entry)
+            self._drop_buffer(discard=True)
+            for level in levels:
+                for chunk in utils.chunks(level.read(), 10000):
+                    self.operations.write_many(chunk)
+        finally:
+            for level in levels:
+                level.close()
+        logger.info('Dropped %s operations under removed campaigns and ad groups', planner.pruned)
+        return planner.pruned
+
+    def sort(self, key=None, max_rows=100000):
+        """
+        Rewrites the operations buffer sorted by `key`, a function of the entry or a sequence of field names
+        (see `make_sort_key`), by default the client, the campaign and the dependency level of the
+        object_type. At most `max_rows` entries are sorted in memory at a time, each sorted run is spilled
+        to a temporary buffer and all runs are merged at the end. The sort is stable. Returns the number of
+        sorted runs.
+        """
+        logger.info('Running %s...', inspect.stack()[0][3])
+        if key is None:
+            key = make_sort_key()
+        elif not callable(key):
+            key = make_sort_key(key)
+        runs = []
+        try:
+            for chunk in utils.chunks(self._read_buffer(), max_rows):
+                chunk.sort(key=key)
+                run = buffers.OperationsBuffer(self.serializer, self.compression)
+                run.write_many(chunk)
+                runs.append(run)
+            self._drop_buffer(discard=True)
+            for chunk in utils.chunks(heapq.merge(*[run.read() for run in runs], key=key), max_rows):
+                self.operations.write_many(chunk)
+        finally:
+            for run in runs:
+                run.close()
+        logger.info('Sorted operations in %s runs', len(runs))
+        return len(runs)
 
     def get_report(self, report_type, customer_id, exclude_fields=[],
                    exclude_terms=['Significance'], exclude_behavior=['Segment'],
@@ -199,7 +482,7 @@ class AdWords:
             report = list(report_iterator())
             return report
 
-    def log_batchjob(self, batchjob_service, file_name, comment=''):
+    def log_batchjob(self, batchjob_service, file_name, comment='', checkpoint=None):
         logger.info('Running %s...', inspect.stack()[0][3])
         client_id = batchjob_service.client.client_customer_id
         batchjob_id = batchjob_service.batch_job.result['value'][0].id
@@ -212,7 +495,10 @@ class AdWords:
                 'result_url': '',
                 'metadata': comment,
                 'status': batchjob_status}
+        if checkpoint:
+            data.update(checkpoint)
         self._write_entry(file_name, data)
+        return data
 
     def _update_jobs_status(self, jobs):
         logger.info('Running %s...', inspect.stack()[0][3])
@@ -246,7 +532,17 @@ class AdWords:
 
     def _collect_jobs(self, operations_folder):
         batchjobs = {}
-        for operation in self._read_from_folder(operations_folder, name_filter=lambda x: x.endswith('.result')):
+        manifest = self._read_folder_manifest(operations_folder)
+        if manifest is not None:
+            _, folder_files = self.storage.listdir(operations_folder)
+            folder_files = set(folder_files)
+            result_files = [path.join(operations_folder, data_file + '.result') for data_file in manifest['files']
+                            if utils.compressed_name(data_file + '.result', self.compression) in folder_files]
+            operations = (operation for result_file in result_files
+                          for operation in self._read_and_close(result_file))
+        else:
+            operations = self._read_from_folder(operations_folder, name_filter=lambda x: x.endswith('.result'))
+        for operation in operations:
             client_id = operation['client_id']
             if operation['status'] != 'DONE' and operation['status'] != 'CANCELED':
                 batchjobs.setdefault(client_id, {})[operation['batchjob_id']] = operation
@@ -271,47 +567,340 @@ class AdWords:
         self.flush_files()
         return jobs
 
-    def split(self, operations_folder=''):
-        operations_folder = operations_folder or str(uuid.uuid1())
-        for entry in self._read_buffer():
-            self._write_entry(path.join(operations_folder, '{}.data'.format(entry['campaign_id'])), entry)
+    def split(self, operations_folder='', max_open_files=None, max_job_operations=None, max_job_bytes=None,
+              workers=None, max_campaign_operations=None):
+        """
+        Writes the buffered operations to one `.data` file per campaign, keeping at most `max_open_files`
+        (by default, the one of the client) of them open at a time (see `utils.FilePool`).
 
-        def _close_file(file_handler):
-            file_handler.flush()
-            file_handler.close()
+        A client created with `partition_by` has already written the data files while inserting, so split
+        only writes their manifest and returns their folder. Their files can not be packed or sharded
+        anymore, asking for it raises a ValueError.
 
-        with ThreadPoolExecutor() as executor:
-            executor.map(_close_file, self.open_files.values())
+        When `max_job_operations` or `max_job_bytes` is set, the campaigns of each client are packed instead
+        into files (and batch jobs) of up to that many operations or serialized bytes, named
+        `<client_id>-<job>.data`. See `CampaignPacker`.
 
-        self.open_files.clear()
+        With `max_campaign_operations`, campaigns over that many operations are sharded at ad group
+        boundaries into `<campaign_id>-<shard>.data` files (or shards packed separately), so a huge
+        campaign does not end up in a single batch job. See `CampaignSharder`.
+
+        With `workers`, the buffer file is divided into that many byte ranges that are partitioned in
+        parallel through the `map_function` and merged at the end, giving the same files. Buffers that can
+        not be read by ranges (compressed, binary, in memory or durable ones) are split serially.
+        """
+        if self.partition_by:
+            if max_job_operations or max_job_bytes or max_campaign_operations:
+                raise ValueError('The data files of a client created with partition_by are already written, '
+                                 'they can not be packed or sharded')
+            return self._finish_partitions()
+        max_open_files = max_open_files or self.max_open_files
+        operations_folder = operations_folder or str(uuid.uuid1())
+        sharder = None
+        if max_campaign_operations:
+            sharder = CampaignSharder(max_campaign_operations)
+            for entry in self._read_buffer():
+                sharder.add(entry)
+            sharder.shard()
+        jobs = None
+        if max_job_operations or max_job_bytes:
+            jobs = self._pack_campaigns(max_job_operations, max_job_bytes, sharder)
+        partitioner = Partitioner(jobs, sharder)
+        ranges = self.operations.ranges(workers) if workers and workers > 1 else None
+        if ranges and len(ranges) > 1:
+            manifest = self._parallel_split(operations_folder, ranges, partitioner, max_open_files)
+        else:
+            manifest = self._serial_split(operations_folder, partitioner, max_open_files)
+        self._write_manifest(operations_folder, manifest)
         return operations_folder
 
-    def _batch_operations(self, file_name):
+    def _finish_partitions(self):
+        buffer = self.operations
+        self._write_manifest(buffer.folder, buffer.manifest())
+        # the data files are the result of the split, new operations go to a new folder
+        self._drop_buffer()
+        logger.info('Finished %s data files written at insert time', len(buffer.files))
+        return buffer.folder
+
+    def _serial_split(self, operations_folder, partitioner, max_open_files):
+        dumps = self.serializer.dumps
+        pool = utils.FilePool(self._open_file, max_open_files, append=storages.is_local(self.storage))
+        manifest = OrderedDict()
+        checksums = {}
+        try:
+            for entry in self._read_buffer():
+                file_name = partitioner(entry)
+                data = dumps(entry)
+                pool.write(path.join(operations_folder, file_name), data)
+                utils.add_file_stats(manifest, file_name, entry, len(data))
+                checksum = checksums.get(file_name)
+                if checksum is None:
+                    checksum = checksums[file_name] = hashlib.sha256()
+                checksum.update(data)
+        finally:
+            pool.close()
+        for file_name, stats in manifest.items():
+            stats['checksum'] = checksums[file_name].hexdigest()
+        logger.info('Split operations into %s files with %s evictions', len(pool.created), pool.evictions)
+        return manifest
+
+    def _parallel_split(self, operations_folder, ranges, partitioner, max_open_files):
+        with TemporaryDirectory() as parts_folder:
+            tasks = [(file_name, start, end, self.serializer, path.join(parts_folder, str(index)), partitioner,
+                      max_open_files)
+                     for index, (file_name, start, end) in enumerate(ranges)]
+            logger.info('Splitting %s buffer ranges in parallel...', len(tasks))
+            parts = list(self.map_function(_split_range, tasks))
+            manifest = OrderedDict()
+            for part in parts:
+                for file_name, part_stats in part.items():
+                    stats = manifest.get(file_name)
+                    if stats is None:
+                        stats = manifest[file_name] = {'client_ids': [], 'operations': {}, 'bytes': 0}
+                    stats['client_ids'].extend(client_id for client_id in part_stats['client_ids']
+                                               if client_id not in stats['client_ids'])
+                    for object_type, count in part_stats['operations'].items():
+                        stats['operations'][object_type] = stats['operations'].get(object_type, 0) + count
+                    stats['bytes'] += part_stats['bytes']
+
+            def merge(file_name):
+                checksum = hashlib.sha256()
+                with self._open_file(path.join(operations_folder, file_name), 'wb') as file:
+                    for index, part in enumerate(parts):
+                        if file_name in part:
+                            with open(path.join(parts_folder, str(index), file_name), 'rb') as part_file:
+                                for chunk in iter(lambda: part_file.read(1024 * 1024), b''):
+                                    checksum.update(chunk)
+                                    file.write(chunk)
+                manifest[file_name]['checksum'] = checksum.hexdigest()
+
+            with ThreadPoolExecutor() as executor:
+                list(executor.map(merge, list(manifest)))
+        logger.info('Merged %s files from %s buffer ranges', len(manifest), len(ranges))
+        return manifest
+
+    def _write_manifest(self, operations_folder, files):
+        manifest = {
+            'serializer': self.serializer.name,
+            'compression': self.compression,
+            'files': files,
+        }
+        with self.storage.open(path.join(operations_folder, MANIFEST_NAME), 'wb') as file:
+            file.write(json.dumps(manifest).encode('utf-8'))
+
+    def read_manifest(self, operations_folder):
+        """
+        Manifest written by `split`, with the client ids, operations per object_type, serialized size and
+        sha256 checksum (both of the uncompressed data) of each `.data` file in the folder. Returns None
+        for folders without one.
+        """
+        manifest_name = path.join(operations_folder, MANIFEST_NAME)
+        if not self.storage.exists(manifest_name):
+            return None
+        with self.storage.open(manifest_name, 'rb') as file:
+            return json.loads(file.read().decode('utf-8'))
+
+    def _read_folder_manifest(self, operations_folder):
+        """
+        Manifest of a folder whose files are about to be read, which must have been written with the
+        serializer and compression of this client. A client with the `auto` serializer takes the serializer of
+        the folder instead.
+        """
+        manifest = self.read_manifest(operations_folder)
+        if manifest is not None and self.auto_serializer and manifest['serializer'] != self.serializer.name:
+            logger.info('Using the %s serializer of %s', manifest['serializer'], operations_folder)
+            self.serializer = get_serializer(manifest['serializer'])
+        if manifest is not None and (manifest['serializer'], manifest['compression']) != (self.serializer.name,
+                                                                                          self.compression):
+            raise ValueError('{} was written with the {} serializer and {} compression, but this client uses the {} '
+                             'serializer and {} compression'.format(operations_folder, manifest['serializer'],
+                                                                    manifest['compression'], self.serializer.name,
+                                                                    self.compression))
+        return manifest
+
+    def _pack_campaigns(self, max_operations=None, max_bytes=None, sharder=None):
+        packer = CampaignPacker(max_operations, max_bytes)
+        dumps = self.serializer.dumps
+        for entry in self._read_buffer():
+            size = len(dumps(entry)) if max_bytes else 0
+            shard = sharder.get_shard(entry) if sharder else 0
+            packer.add(entry['client_id'], (entry.get('campaign_id'), shard), size)
+        return packer.pack()
+
+    def _new_chunker(self):
+        if self.upload_chunk_bytes:
+            return UploadChunker(target_bytes=self.upload_chunk_bytes, max_bytes=self.upload_max_chunk_bytes)
+        return UploadChunker(max_operations=BATCH_SIZE)
+
+    def _batch_operations(self, file_name, resume=True):
         logger.info('Processing operation file %s', file_name)
         bjs = self.service('BatchJobService')
-        operation_builder = OperationsBuilder(self.min_id)
+        bjs.xml_serializer = self.xml_serializer
+        result_file = file_name + '.result'
+        done_file = file_name + '.done'
+        if self.storage.exists(done_file):
+            self.storage.delete(done_file)
+        checkpoints = self._read_checkpoints(result_file) if resume else []
+        # the temporary ids must be the ones of the run that is resumed, so its operations are skipped and
+        # the new ones reference the same entities
+        min_id = checkpoints[0].get('min_id', self.min_id) if checkpoints else self.min_id
+        operation_builder = OperationsBuilder(min_id)
+        # the result file is written again, starting with the jobs of the previous run, which are flushed
+        # before anything is uploaded so a crash does not lose them
+        for checkpoint in checkpoints:
+            self._write_entry(result_file, checkpoint)
+        if checkpoints:
+            self.get_file(result_file).flush()
         previous_client_id = None
-        batch_size = 5000
-        run_final_upload = False
-        for internal_operation in self._read_entries(file_name):
-            run_final_upload = True
-            client_id = internal_operation['client_id']
+        job_index = -1
+        job_done = True
+        skip = 0
+        chunker = self._new_chunker()
+        pipeline = None
+        try:
+            for internal_operation in self._read_entries(file_name):
+                client_id = internal_operation['client_id']
+                if client_id != previous_client_id:
+                    if not job_done:
+                        self._upload_chunk(bjs, pipeline, is_last=True)
+                    pipeline = self._close_pipeline(pipeline)
+                    previous_client_id = client_id
+                    job_index += 1
+                    checkpoint = checkpoints[job_index] if job_index < len(checkpoints) else None
+                    if checkpoint is not None and str(checkpoint['client_id']) != str(client_id):
+                        logger.warning('Clients of %s changed since its last run, creating new jobs', file_name)
+                        checkpoints = []
+                        checkpoint = None
+                    job_done, skip = self._start_job(bjs, client_id, checkpoint, result_file, min_id)
+                    if not job_done:
+                        bjs.helper.chunker = chunker
+                        chunker.start_job(bjs.helper.operations_xml)
+                        if self.upload_queue_size:
+                            pipeline = UploadPipeline(bjs.helper, self.upload_queue_size)
+                for operation in operation_builder(make_record(internal_operation)):
+                    if not operation or job_done:
+                        continue
+                    if skip:
+                        # already uploaded by the run that is resumed
+                        skip -= 1
+                        continue
+                    if chunker.cut(operation):
+                        self._upload_chunk(bjs, pipeline)
+                    bjs.helper.add_operation(operation)
+            if not job_done:
+                self._upload_chunk(bjs, pipeline, is_last=True)
+            pipeline = self._close_pipeline(pipeline)
+            self.flush_files()
+            with self.storage.open(done_file, 'wb') as file:
+                file.write(json.dumps({'finish_time': datetime.datetime.now().isoformat()}).encode('utf-8'))
+        except BaseException as e:
+            # the error being raised is not replaced by the one of a background upload
+            self._close_pipeline(pipeline, e)
+            raise
+        finally:
+            # the checkpoints of a failed run are kept, so the next run resumes its jobs
+            self.flush_files()
+
+    def _start_job(self, bjs, client_id, checkpoint, result_file, min_id):
+        """
+        Creates the batch job of a client or resumes the one of its checkpoint. Returns whether the job is
+        fully uploaded already and how many of its operations were uploaded.
+        """
+        if checkpoint is None:
+            bjs.prepare_job(int(client_id))
+            job = self.log_batchjob(bjs, result_file, checkpoint=dict(bjs.helper.checkpoint(), min_id=min_id))
+        elif checkpoint.get('is_last', True):
+            logger.info('Batchjob %s was fully uploaded, skipping it', checkpoint['batchjob_id'])
+            return True, 0
+        else:
+            bjs.resume_job(int(client_id), checkpoint)
+            job = checkpoint
+        # the open files are per thread, so the handle of this thread is the one given to the upload callback,
+        # which may run on the thread of an `UploadPipeline`
+        result = self.get_file(result_file, mode='w+b')
+        bjs.helper.on_upload = lambda upload_checkpoint: self._write_checkpoint(result,
+                                                                                dict(job, **upload_checkpoint))
+        return False, bjs.helper.uploaded_operations
+
+    def _write_checkpoint(self, file, entry):
+        with _checkpoint_lock:
+            self.serializer.dump(entry, file)
+            file.flush()
+
+    def _read_checkpoints(self, result_file):
+        """
+        Last entry of each job of a `.result` file, in the order the jobs were created
+
+        A process killed while writing the file leaves it without its last entry (or, compressed, without
+        the end of the stream), every checkpoint flushed before that is still read.
+        """
+        if not self._result_exists(result_file):
+            return []
+        jobs = OrderedDict()
+        try:
+            for entry in self._read_and_close(result_file):
+                jobs[entry['batchjob_id']] = entry
+        except (EOFError, ValueError, zlib.error):
+            logger.warning('Result file %s is truncated, resuming from its last complete checkpoint', result_file)
+        return list(jobs.values())
+
+    @staticmethod
+    def _upload_chunk(bjs, pipeline, is_last=False):
+        if pipeline is None:
+            bjs.helper.upload_operations(is_last=is_last)
+        else:
+            pipeline.submit(is_last=is_last)
+
+    @staticmethod
+    def _close_pipeline(pipeline, error=None):
+        if pipeline is not None:
+            pipeline.close(error)
+
+    def update_bids(self, client_ids, adgroup_ids, criterion_ids, cpc_bids, operations_folder=''):
+        """
+        Changes cpc bids straight from parallel sequences (lists, array.array, ...), skipping the operations
+        buffer and the builder. Rows with a criterion id change a keyword bid, rows where it is empty (or
+        `criterion_ids` is None) change an ad group bid. A new batch job is created whenever the client id
+        changes, so rows should be grouped by client. Returns the folder with the `.result` files of the jobs,
+        to be used with `wait_jobs`.
+
+        There is no data file to resume from, so the jobs are not checkpointed: setting a bid again is
+        harmless, a failed call is simply repeated with the same sequences.
+        """
+        logger.info('Running %s...', inspect.stack()[0][3])
+        if criterion_ids is None:
+            criterion_ids = [None] * len(adgroup_ids)
+        if not len(client_ids) == len(adgroup_ids) == len(criterion_ids) == len(cpc_bids):
+            raise ValueError('The bid sequences must have the same length, got {} client ids, {} ad group ids, '
+                             '{} criterion ids and {} bids'.format(len(client_ids), len(adgroup_ids),
+                                                                   len(criterion_ids), len(cpc_bids)))
+        operations_folder = operations_folder or str(uuid.uuid1())
+        micro_bids = list(map(cents_as_money, cpc_bids))
+        bjs = self.service('BatchJobService')
+        previous_client_id = None
+        in_batch = 0
+        for client_id, adgroup_id, criterion_id, micro_bid in zip(client_ids, adgroup_ids, criterion_ids, micro_bids):
+            if micro_bid is None:
+                logger.warning('Skipping invalid bid for ad group %s criterion %s', adgroup_id, criterion_id)
+                continue
             if client_id != previous_client_id:
                 if previous_client_id is not None:
                     bjs.helper.upload_operations(is_last=True)
                 previous_client_id = client_id
                 bjs.prepare_job(int(client_id))
-                self.log_batchjob(bjs, file_name + '.result')
+                self.log_batchjob(bjs, path.join(operations_folder, '{}.bids.result'.format(client_id)))
                 in_batch = 0
-            for operation in operation_builder(internal_operation):
-                if operation:
-                    if in_batch > 0 and in_batch % batch_size == 0:
-                        bjs.helper.upload_operations()
-                    bjs.helper.add_operation(operation)
-                    in_batch += 1
-        if run_final_upload:
+            if in_batch > 0 and in_batch % BATCH_SIZE == 0:
+                bjs.helper.upload_operations()
+            if criterion_id:
+                bjs.helper.add_operation(keyword.keyword_bid_operation(int(adgroup_id), int(criterion_id), micro_bid))
+            else:
+                bjs.helper.add_operation(adgroup.adgroup_bid_operation(int(adgroup_id), micro_bid))
+            in_batch += 1
+        if previous_client_id is not None:
             bjs.helper.upload_operations(is_last=True)
         self.flush_files()
+        return operations_folder
 
     def _get_service_from_object_type(self, internal_operation):
         object_type_service_mapper = {
@@ -362,7 +951,7 @@ class AdWords:
         results = []
         errors = []
         number_of_operations = 0
-        max_operations = 1000
+        max_operations = SYNC_BATCH_SIZE
         service = None
         client_id = None
         for internal_operation in self._read_buffer():
@@ -371,7 +960,7 @@ class AdWords:
             service = self.service(service_name)
             if not number_of_operations:
                 service.prepare_mutate(sync=True)
-            for adwords_operation in operation_builder(internal_operation, sync=True):
+            for adwords_operation in operation_builder(make_record(internal_operation), sync=True):
                 if adwords_operation:
                     number_of_operations += 1
                     service.helper.add_operation(adwords_operation)
@@ -389,9 +978,45 @@ class AdWords:
                 partial_errors = get_errors() if callable(get_errors) else []
                 results.extend(partial_results)
                 errors.extend(partial_errors)
-        self._operations_buffer = None
+        self._drop_buffer(discard=True)
         return results, errors
 
+    def _result_exists(self, file_name):
+        return self.storage.exists(utils.compressed_name(file_name, self.compression))
+
+    def _list_data_files(self, operations_folder, folder_files=None):
+        """
+        Maps the name of each `.data` file in the folder to its `.result` file, or None when it has not been
+        executed yet. Uses the manifest, with the biggest files first, when the folder has one.
+        `folder_files` are the files listed in the folder, when they were listed already.
+        """
+        if folder_files is None:
+            _, folder_files = self.storage.listdir(operations_folder)
+        manifest = self._read_folder_manifest(operations_folder)
+        if manifest is not None:
+            folder_files = set(folder_files)
+            data_files = sorted(manifest['files'], key=lambda name: -manifest['files'][name]['bytes'])
+            return OrderedDict(
+                (data_file, data_file + '.result'
+                 if utils.compressed_name(data_file + '.result', self.compression) in folder_files else None)
+                for data_file in data_files
+            )
+        files = {}
+        for file_path in folder_files:
+            file_path = utils.uncompressed_name(file_path)
+            data_file = None
+            result_file = None
+            if file_path.endswith('.data'):
+                data_file = file_path
+            elif file_path.endswith('.data.result'):
+                data_file, _, _ = file_path.rpartition('.')
+                result_file = file_path
+            if data_file:
+                # if entry has been set before (if we saw .result first)
+                # avoid overwriting the result file value
+                files[data_file] = files.get(data_file) or result_file
+        return files
+
     # TODO: this method should instantiate a new class (maybe SyncOperation) and transform the internal functions
     # into instance methods. Also, separate the treatment for each "object_type" into a new method as well.
     def execute_operations(self, operations_folder=None, sync=False, force_all=False):
@@ -401,24 +1026,93 @@ class AdWords:
             if not operations_folder:
                 raise ValueError('Async operations must have an operation folder defined.')
             logger.info('Running %s...', inspect.stack()[0][3])
-            _, folder_files = self.storage.listdir(operations_folder)
-            files = {}
-            for file_path in folder_files:
-                data_file = None
-                result_file = None
-                if file_path.endswith('.data'):
-                    data_file = file_path
-                elif file_path.endswith('.result'):
-                    data_file, _, _ = file_path.rpartition('.')
-                    result_file = file_path
-                if data_file:
-                    # if entry has been set before (if we saw .result first)
-                    # avoid overwriting the result file value
-                    files[data_file] = files.get(data_file) or result_file
-            selected_files = [path.join(operations_folder, f) for f, data in files.items() if not data or force_all]
+            selected_files = [path.join(operations_folder, f)
+                              for f in self._select_data_files(operations_folder, force_all)]
             self._reset()
             logger.info('Applyting map function to operation files...')
-            return list(self.map_function(self._batch_operations, selected_files))
+            return list(self.map_function(partial(self._batch_operations, resume=not force_all), selected_files))
+
+    def _select_data_files(self, operations_folder, force_all=False):
+        """
+        Data files to be executed: the ones without a `.result` file or whose run did not finish (it has no
+        `.done` marker), or all of them with `force_all`
+        """
+        _, folder_files = self.storage.listdir(operations_folder)
+        data_files = self._list_data_files(operations_folder, folder_files)
+        folder_files = set(folder_files)
+        return [data_file for data_file, result_file in data_files.items()
+                if force_all or not result_file or data_file + '.done' not in folder_files]
+
+    def plan(self, operations_folder=None, sync=False, force_all=False):
+        """
+        Dry run of `execute_operations` with the same arguments: builds every operation without calling the
+        API and returns what the run would cost. Without `operations_folder`, batch jobs are estimated for
+        the files a plain `split` would write. The report has the totals of `jobs`, `uploads` (batch) or
+        `requests` (sync), `operations`, `units` and `bytes`, the same numbers per client in `clients` and
+        the operations per API service in `services`.
+
+        `units` are counted like the daily operations quota of the API: one per operation, plus one per
+        batch job for the BatchJobService call creating it (polling the jobs is left out). `bytes` is the
+        size of the operations as XML, written without the API schema (see `schemaless_operations_xml`),
+        an estimate slightly below the uploaded payloads. Chunks sized in bytes are cut on the same
+        estimate, so `uploads` may come out a little lower than in the actual run.
+        """
+        logger.info('Running %s...', inspect.stack()[0][3])
+        report = {'route': 'sync' if sync else 'batch', 'jobs': 0, 'uploads': 0, 'requests': 0,
+                  'operations': 0, 'units': 0, 'bytes': 0, 'clients': {}, 'services': {}}
+        if sync or not operations_folder:
+            # a reopened durable buffer only knows the ids written to it once it is opened
+            buffer = self.operations
+        operation_builder = OperationsBuilder(self.min_id)
+        xml_serializer = BatchJobXmlSerializer()
+        if sync:
+            entries = (('sync', entry) for entry in buffer.read())
+        elif operations_folder:
+            entries = ((file_name, entry) for file_name in self._select_data_files(operations_folder, force_all)
+                       for entry in self._read_and_close(path.join(operations_folder, file_name)))
+        else:
+            partitioner = Partitioner(by_client=self.partition_by == 'client')
+            entries = ((partitioner(entry), entry) for entry in buffer.read())
+        # partition -> [client_id, chunker of the current job, intermediate uploads of the current job]
+        current_jobs = {}
+
+        def finish_job(current_job):
+            report['uploads'] += current_job[2] + 1
+
+        for partition, internal_operation in entries:
+            client_id = internal_operation['client_id']
+            client_report = report['clients'].get(client_id)
+            if client_report is None:
+                client_report = report['clients'][client_id] = {'jobs': 0, 'operations': 0, 'units': 0, 'bytes': 0}
+            if sync:
+                service_name = self._get_service_from_object_type(internal_operation) or 'unsupported'
+            else:
+                current_job = current_jobs.get(partition)
+                if current_job is None or current_job[0] != client_id:
+                    if current_job is not None:
+                        finish_job(current_job)
+                    current_job = current_jobs[partition] = [client_id, self._new_chunker(), 0]
+                    report['jobs'] += 1
+                    report['units'] += 1
+                    client_report['jobs'] += 1
+                    client_report['units'] += 1
+            for operation in operation_builder(make_record(internal_operation), sync=sync or None):
+                if not operation:
+                    continue
+                if not sync:
+                    service_name = operation.get('xsi_type', 'Operation').replace('Operation', 'Service')
+                    current_job[2] += current_job[1].cut(operation)
+                size = len(xml_serializer.serialize([[operation]], schemaless_operations_xml))
+                report['services'][service_name] = report['services'].get(service_name, 0) + 1
+                for totals in (report, client_report):
+                    totals['operations'] += 1
+                    totals['units'] += 1
+                    totals['bytes'] += size
+        for current_job in current_jobs.values():
+            finish_job(current_job)
+        if sync:
+            report['requests'] = -(-report['operations'] // SYNC_BATCH_SIZE)
+        return report
 
     def get_accounts(self, client_id=None):
         logger.info('Getting accounts for client_id %s...', client_id or self.client.client_customer_id)
@@ -1,5 +1,6 @@
 import logging
 from .mappers import cast_to_adwords
+from .records import Record
 from ..adwords_api.operations import (campaign, adgroup, keyword, ad, label, campaign_shared_set, shared_criterion,
                                       shared_set, managed_customer, budget_order, attach_label,
                                       campaign_extensions_setting, campaign_criterion, utils, offline_conversion_feed,
@@ -60,7 +61,9 @@ class OperationsBuilder:
     def _parse_operation(self, operation, sync=None):
         if self.valid_operation(operation):
             object_type = operation.get('object_type')
-            operation = self.filter_operation(self.cast_operation(operation))
+            # records are already cast and filtered
+            if not isinstance(operation, Record):
+                operation = self.filter_operation(self.cast_operation(operation))
             if object_type == 'keyword':
                 yield from self._parse_keyword(operation)
             elif object_type == 'adgroup':
@@ -0,0 +1,154 @@
+import json
+import logging
+import sqlite3
+
+from .planner import is_remove
+
+logger = logging.getLogger(__name__)
+
+# Fields that identify the entity changed by an internal operation of each object_type
+ENTITY_KEYS = {
+    'campaign': ('campaign_id',),
+    'adgroup': ('adgroup_id',),
+    'keyword': ('adgroup_id', 'criteria_id'),
+    'ad': ('adgroup_id', 'ad_id'),
+}
+
+
+def get_entity_key(operation):
+    """
+    Key of the entity changed by the operation or None if it can not be coalesced
+
+    >>> get_entity_key({'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 2, 'adgroup_id': 3})
+    '["adgroup", 1, 3]'
+    """
+    object_type = operation.get('object_type')
+    fields = ENTITY_KEYS.get(object_type)
+    if not fields or 'fields' in operation or 'default_fields' in operation:
+        return None
+    key = [object_type, operation.get('client_id')]
+    for field in fields:
+        value = operation.get(field)
+        if value is None:
+            return None
+        key.append(value)
+    return json.dumps(key)
+
+
+def _get_operator(operation):
+    if is_remove(operation):
+        return 'REMOVE'
+    return (operation.get('operator') or 'ADD').upper()
+
+
+def _get_reference(operation, field):
+    value = operation.get(field)
+    if value is None:
+        return None
+    return json.dumps([operation.get('client_id'), value])
+
+
+class OperationsCoalescer:
+    """
+    Collapses the operations on the same entity (object_type, client_id and ids) into a single one
+
+    Later operations win field by field and the result keeps the position of the first operation on the
+    entity. A SET over an ADD is merged into the ADD. A REMOVE (or a SET of the REMOVED status, the way
+    campaigns and ad groups are removed) replaces whatever came before it and takes its own position, so
+    it stays after the operations that still use the entity. An ADD followed by a REMOVE drops both,
+    along with every operation referencing the campaign or ad group that is never created (its ad
+    groups, keywords, ads...), before or after the REMOVE. Operations are kept in an
+    on-disk SQLite index, so memory does not grow with the number of operations.
+    """
+    def __init__(self, database=''):
+        # an empty database name is a private on-disk database, removed when the connection is closed
+        self.connection = sqlite3.connect(database)
+        self.connection.execute('CREATE TABLE operations ('
+                                'position INTEGER PRIMARY KEY, '
+                                'key TEXT UNIQUE, '
+                                'campaign TEXT, '
+                                'adgroup TEXT, '
+                                'entry TEXT NOT NULL)')
+        self.connection.execute('CREATE INDEX operations_campaign ON operations (campaign)')
+        self.connection.execute('CREATE INDEX operations_adgroup ON operations (adgroup)')
+        self.position = 0
+        self.received = 0
+        self.dropped = 0
+        # (client_id, id) references of the campaigns and ad groups added and removed
+        self.cancelled = {'campaign_id': set(), 'adgroup_id': set()}
+
+    def _insert(self, key, operation):
+        self.connection.execute('INSERT INTO operations VALUES (?, ?, ?, ?, ?)',
+                                (self.position, key, _get_reference(operation, 'campaign_id'),
+                                 _get_reference(operation, 'adgroup_id'), json.dumps(operation)))
+
+    def _is_cancelled(self, operation):
+        campaign, adgroup = _get_reference(operation, 'campaign_id'), _get_reference(operation, 'adgroup_id')
+        if campaign in self.cancelled['campaign_id']:
+            if adgroup is not None:
+                # the ad group is in a campaign that is never created, so it is not created either
+                self.cancelled['adgroup_id'].add(adgroup)
+            return True
+        return adgroup in self.cancelled['adgroup_id']
+
+    def _cancel(self, operation):
+        """
+        Deletes the operations referencing the campaign or ad group of an operation that is added and removed
+        """
+        adgroups = set()
+        if operation.get('object_type') == 'campaign':
+            campaign = _get_reference(operation, 'campaign_id')
+            self.cancelled['campaign_id'].add(campaign)
+            rows = self.connection.execute('SELECT position, adgroup FROM operations WHERE campaign = ?',
+                                           (campaign,)).fetchall()
+            adgroups.update(adgroup for _, adgroup in rows if adgroup is not None)
+            self.connection.executemany('DELETE FROM operations WHERE position = ?',
+                                        [(position,) for position, _ in rows])
+            self.dropped += len(rows)
+        elif operation.get('object_type') == 'adgroup':
+            adgroups.add(_get_reference(operation, 'adgroup_id'))
+        for adgroup in adgroups:
+            self.cancelled['adgroup_id'].add(adgroup)
+            self.dropped += self.connection.execute('DELETE FROM operations WHERE adgroup = ?', (adgroup,)).rowcount
+
+    def add(self, operation):
+        self.received += 1
+        self.position += 1
+        if self._is_cancelled(operation):
+            self.dropped += 1
+            return
+        key = get_entity_key(operation)
+        previous = None
+        if key is not None:
+            previous = self.connection.execute('SELECT position, entry FROM operations WHERE key = ?',
+                                               (key,)).fetchone()
+        if previous is None:
+            self._insert(key, operation)
+            return
+        position, previous_operation = previous[0], json.loads(previous[1])
+        previous_operator, operator = _get_operator(previous_operation), _get_operator(operation)
+        self.dropped += 1
+        if operator == 'REMOVE' and previous_operator == 'ADD':
+            logger.debug('Dropping added and removed entity %s', key)
+            self.connection.execute('DELETE FROM operations WHERE position = ?', (position,))
+            self.dropped += 1
+            self._cancel(operation)
+            return
+        if operator == 'REMOVE' or previous_operator == 'REMOVE':
+            self.connection.execute('DELETE FROM operations WHERE position = ?', (position,))
+            self._insert(key, operation)
+            return
+        merged = previous_operation
+        merged.update(operation)
+        merged['operator'] = previous_operator if previous_operator == 'ADD' else operator
+        self.connection.execute('UPDATE operations SET campaign = ?, adgroup = ?, entry = ? WHERE position = ?',
+                                (_get_reference(merged, 'campaign_id'), _get_reference(merged, 'adgroup_id'),
+                                 json.dumps(merged), position))
+
+    def __iter__(self):
+        cursor = self.connection.execute('SELECT entry FROM operations ORDER BY position')
+        for row in cursor:
+            yield json.loads(row[0])
+
+    def close(self):
+        self.connection.close()
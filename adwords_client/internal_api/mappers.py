@@ -1,6 +1,10 @@
+import inspect
 import re
 import math
+from collections import OrderedDict
+from functools import lru_cache
 from ..adwords_api import operations
+from ..adwords_api.operations import label, offline_conversion_feed
 from datetime import datetime
 import dateutil.parser
 
@@ -99,6 +103,16 @@ MAPPERS = {
     'DateTime': AdwordsMapper(process_str_to_datetime, process_json_datetime_to_adw_format),
 }
 
+# Parsers for the text values of bulk files, they produce the same python values that `insert` expects
+# (bids and budgets in currency units, not micros) since the AdWords casting happens later, in the builder
+TEXT_PARSERS = {
+    'Money': cast_float,
+    'Bid': cast_float,
+    'Double': cast_float,
+    'Long': cast_int,
+    'Integer': cast_int,
+}
+
 FIELD_MAP = {
     'client_id': 'Long',
     'campaign_id': 'Long',
@@ -118,5 +132,86 @@ FIELD_MAP.update(operations.campaign.add_budget.__annotations__)
 FIELD_MAP.update(operations.campaign.campaign_operation.__annotations__)
 
 
+# Operation functions used by each object_type, the annotations on their arguments
+# describe the fields that an internal operation of that object_type is expected to carry
+OPERATIONS_MAP = {
+    'campaign': (operations.campaign.campaign_operation,
+                 operations.campaign.add_budget,
+                 operations.campaign.add_campaign_language,
+                 operations.campaign.add_campaign_location),
+    'adgroup': (operations.adgroup.adgroup_operation,),
+    'keyword': (operations.keyword.new_keyword_operation,),
+    'ad': (operations.ad.expanded_ad_operation,),
+    'label': (label.new_label_operation,),
+    'attach_label': (operations.attach_label.attach_label_operation,),
+    'managed_customer': (operations.managed_customer.managed_customer_operation,),
+    'budget_order': (operations.budget_order.budget_order_operation,),
+    'shared_set': (operations.shared_set.shared_set_operation,),
+    'shared_criterion': (operations.shared_criterion.shared_criterion_operation,),
+    'campaign_shared_set': (operations.campaign_shared_set.campaign_shared_set_operation,),
+    'campaign_sitelink': (operations.campaign_extensions_setting.sitelink_setting_for_campaign_operation,),
+    'campaign_callout': (operations.campaign_extensions_setting.callout_setting_for_campaign_operation,),
+    'campaign_structured_snippet':
+        (operations.campaign_extensions_setting.structured_snippet_setting_for_campaign_operation,),
+    'campaign_ad_schedule': (operations.campaign_criterion.ad_schedule_operation,),
+    'campaign_targeted_location': (operations.campaign_criterion.targeted_location_operation,),
+    'offline_conversion': (offline_conversion_feed.add_offline_conversion_feed_operation,
+                           offline_conversion_feed.set_offline_conversion_feed_operation),
+    'user_list': (operations.user_list.user_list_operation,),
+    'user_list_member': (operations.user_list.list_members_operation,),
+}
+
+# Fields every internal operation may have, regardless of its object_type
+COMMON_FIELDS = OrderedDict([
+    ('client_id', 'Long'),
+    ('campaign_id', 'Long'),
+    ('operator', 'String'),
+    ('status', 'String'),
+])
+
+
+@lru_cache()
+def get_object_type_fields(object_type):
+    """
+    Ordered mapping of field name to AdWords type for the internal operations of a given object_type
+
+    >>> list(get_object_type_fields('keyword'))[:6]
+    ['client_id', 'campaign_id', 'operator', 'status', 'adgroup_id', 'criteria_id']
+    """
+    fields = OrderedDict(COMMON_FIELDS)
+    for function in OPERATIONS_MAP.get(object_type, ()):
+        # the signature keeps the argument order, so the result is the same in every process
+        for name, parameter in inspect.signature(function).parameters.items():
+            if name not in fields and isinstance(parameter.annotation, str):
+                fields[name] = parameter.annotation
+    return fields
+
+
+@lru_cache()
+def get_id_fields(object_type):
+    """
+    Fields holding AdWords ids (`Long` typed `*_id` fields) of the internal operations of a given object_type
+
+    >>> get_id_fields('adgroup')
+    ('client_id', 'campaign_id', 'adgroup_id', 'ad_id', 'budget_id', 'criteria_id', 'language_id', 'location_id')
+    """
+    fields = OrderedDict(get_object_type_fields(object_type))
+    for name in sorted(FIELD_MAP):
+        fields.setdefault(name, FIELD_MAP[name])
+    return tuple(name for name, field_type in fields.items() if field_type == 'Long' and name.endswith('_id'))
+
+
 def cast_to_adwords(field_name, field_value):
     return MAPPERS[FIELD_MAP.get(field_name, 'Identity')].to_adwords(field_value)
+
+
+def get_text_parser(field_name, object_type=None):
+    """
+    Parser of the text values of a field of a given object_type, by its type in the annotations of the
+    operation functions of the object_type or else in `FIELD_MAP`
+
+    >>> get_text_parser('shared_set_id', 'shared_set')('-3')
+    -3
+    """
+    field_type = get_object_type_fields(object_type).get(field_name) or FIELD_MAP.get(field_name)
+    return TEXT_PARSERS.get(field_type, noop)
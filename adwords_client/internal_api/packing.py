@@ -0,0 +1,137 @@
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CampaignPacker:
+    """
+    Packs the campaigns of each client into batch jobs holding at most `max_operations` operations and
+    `max_bytes` serialized bytes (when set)
+
+    Sizes are collected with `add`, one call per operation, and `pack` assigns every (client_id, campaign_id)
+    to a job of its client. Campaigns are never split, a campaign over the caps gets a job of its own, and
+    they are placed first fit in the order they were first seen, so each job keeps the buffer order.
+    """
+    def __init__(self, max_operations=None, max_bytes=None):
+        self.max_operations = max_operations
+        self.max_bytes = max_bytes
+        # client_id -> campaign_id -> [operations, bytes]
+        self.sizes = OrderedDict()
+
+    def add(self, client_id, campaign_id, size=0):
+        campaigns = self.sizes.get(client_id)
+        if campaigns is None:
+            campaigns = self.sizes[client_id] = OrderedDict()
+        campaign = campaigns.get(campaign_id)
+        if campaign is None:
+            campaign = campaigns[campaign_id] = [0, 0]
+        campaign[0] += 1
+        campaign[1] += size
+
+    def _fits(self, job, operations, size):
+        if self.max_operations and job[0] + operations > self.max_operations:
+            return False
+        if self.max_bytes and job[1] + size > self.max_bytes:
+            return False
+        return True
+
+    def pack(self):
+        """
+        Returns a dict mapping (client_id, campaign_id) to the index of its job inside the client
+        """
+        jobs = {}
+        for client_id, campaigns in self.sizes.items():
+            bins = []
+            for campaign_id, (operations, size) in campaigns.items():
+                for index, job in enumerate(bins):
+                    if self._fits(job, operations, size):
+                        break
+                else:
+                    index, job = len(bins), [0, 0]
+                    bins.append(job)
+                job[0] += operations
+                job[1] += size
+                jobs[client_id, campaign_id] = index
+            logger.debug('Packed %s campaigns of client %s into %s jobs', len(campaigns), client_id, len(bins))
+        return jobs
+
+
+class CampaignSharder:
+    """
+    Divides the campaigns with more than `max_operations` operations into shards of about that size, at ad
+    group boundaries
+
+    Sizes are collected with `add`, one call per operation. The operations without an ad group (the campaign
+    itself, its criteria, ...) stay in the first shard and the ad groups fill the shards in the order they
+    were first seen, so everything that references a temporary (negative) ad group id stays with the
+    operation that creates it. Campaigns with a temporary id are never sharded.
+    """
+    def __init__(self, max_operations):
+        self.max_operations = max_operations
+        # (client_id, campaign_id) -> adgroup_id -> operations
+        self.sizes = OrderedDict()
+        # (client_id, campaign_id, adgroup_id) -> shard, only for sharded campaigns
+        self.shards = {}
+
+    def add(self, operation):
+        campaign_id = operation.get('campaign_id')
+        if isinstance(campaign_id, (int, float)) and campaign_id < 0:
+            return
+        key = (operation.get('client_id'), campaign_id)
+        adgroups = self.sizes.get(key)
+        if adgroups is None:
+            adgroups = self.sizes[key] = OrderedDict()
+        adgroup_id = operation.get('adgroup_id')
+        adgroups[adgroup_id] = adgroups.get(adgroup_id, 0) + 1
+
+    def shard(self):
+        for (client_id, campaign_id), adgroups in self.sizes.items():
+            if sum(adgroups.values()) <= self.max_operations:
+                continue
+            shard_size = adgroups.get(None, 0)
+            shard = 0
+            for adgroup_id, operations in adgroups.items():
+                if adgroup_id is None:
+                    continue
+                if shard_size and shard_size + operations > self.max_operations:
+                    shard += 1
+                    shard_size = 0
+                shard_size += operations
+                if shard:
+                    self.shards[client_id, campaign_id, adgroup_id] = shard
+            logger.debug('Sharded campaign %s of client %s into %s files', campaign_id, client_id, shard + 1)
+        self.sizes = OrderedDict()
+        return self
+
+    def get_shard(self, operation):
+        if not self.shards:
+            return 0
+        return self.shards.get((operation.get('client_id'), operation.get('campaign_id'),
+                                operation.get('adgroup_id')), 0)
+
+
+class Partitioner:
+    """
+    Name of the data file of each operation: `<campaign_id>.data` (or `<campaign_id>-<shard>.data` for the
+    shards of a sharded campaign), `<client_id>-<job>.data` when the campaigns are packed into `jobs` or
+    `<client_id>.data` with `by_client`
+    """
+    def __init__(self, jobs=None, sharder=None, by_client=False):
+        self.jobs = jobs
+        self.sharder = sharder
+        self.by_client = by_client
+
+    def get_shard(self, operation):
+        return self.sharder.get_shard(operation) if self.sharder else 0
+
+    def __call__(self, operation):
+        if self.by_client:
+            return '{}.data'.format(operation['client_id'])
+        shard = self.get_shard(operation)
+        if self.jobs is not None:
+            job = self.jobs[operation['client_id'], (operation.get('campaign_id'), shard)]
+            return '{}-{:04d}.data'.format(operation['client_id'], job)
+        if shard:
+            return '{}-{:04d}.data'.format(operation['campaign_id'], shard)
+        return '{}.data'.format(operation['campaign_id'])
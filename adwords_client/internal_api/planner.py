@@ -0,0 +1,142 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Operations of a level may reference the entities created by the levels before it:
+# budgets and campaigns are built together, then ad groups and campaign criteria, then their children
+DEPENDENCY_LEVELS = {
+    'managed_customer': 0,
+    'customer': 0,
+    'billing_account': 0,
+    'budget_order': 0,
+    'label': 0,
+    'shared_set': 0,
+    'user_list': 0,
+    'campaign': 1,
+    'shared_criterion': 1,
+    'user_list_member': 1,
+    'adgroup': 2,
+    'campaign_shared_set': 2,
+    'campaign_sitelink': 2,
+    'campaign_callout': 2,
+    'campaign_structured_snippet': 2,
+    'campaign_ad_schedule': 2,
+    'campaign_targeted_location': 2,
+    'campaign_language': 2,
+    'keyword': 3,
+    'ad': 3,
+    'attach_label': 4,
+    'offline_conversion': 4,
+}
+# unknown object types go last
+MAX_DEPENDENCY_LEVEL = 5
+
+
+def get_dependency_level(object_type):
+    """
+    >>> get_dependency_level('campaign') < get_dependency_level('adgroup') < get_dependency_level('keyword')
+    True
+    """
+    return DEPENDENCY_LEVELS.get(object_type, MAX_DEPENDENCY_LEVEL)
+
+
+# Default order of `AdWords.sort`: every client and campaign together, parents before children
+DEFAULT_SORT_FIELDS = ('client_id', 'campaign_id', 'object_type')
+
+
+def _sortable(value):
+    # numbers, strings and missing values can all be in the same field
+    if value is None:
+        return 0, 0
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return 1, value
+    return 2, str(value)
+
+
+def make_sort_key(fields=DEFAULT_SORT_FIELDS):
+    """
+    Sort key of the operations by the values of `fields`, where `object_type` sorts by dependency level
+
+    >>> key = make_sort_key()
+    >>> key({'client_id': 1, 'campaign_id': -1, 'object_type': 'campaign'}) < \\
+    ...     key({'client_id': 1, 'campaign_id': -1, 'object_type': 'keyword'})
+    True
+    >>> sorted([2, 'a', None, 1.5], key=_sortable)
+    [None, 1.5, 2, 'a']
+    """
+    fields = tuple(fields)
+
+    def sort_key(operation):
+        return tuple(get_dependency_level(operation.get('object_type')) if field == 'object_type'
+                     else _sortable(operation.get(field)) for field in fields)
+    return sort_key
+
+
+def is_remove(operation):
+    return ((operation.get('operator') or '').upper() == 'REMOVE'
+            or (operation.get('status') or '').upper() == 'REMOVED')
+
+
+def is_add(operation):
+    return (operation.get('operator') or 'ADD').upper() == 'ADD' and not is_remove(operation)
+
+
+class DependencyPlanner:
+    """
+    Finds the operations made redundant by the REMOVE of their campaign or ad group
+
+    Every operation must go through `add` first, so the removed campaigns and ad groups are known whatever
+    the order of the operations, then `is_redundant` tells the operations that can be dropped: any other
+    operation on a removed campaign or ad group or on the entities under them (ad groups, keywords and
+    ads, also when they only give the id of their ad group). The REMOVE itself is kept, unless the entity
+    is also added by the operations: then it never exists and both its ADD and its REMOVE are dropped.
+    """
+    def __init__(self):
+        self.removed_campaigns = set()
+        self.removed_adgroups = set()
+        self.added_campaigns = set()
+        self.added_adgroups = set()
+        # campaign of each ad group, to find the children of a removed campaign that only give their ad group
+        self.adgroup_campaigns = {}
+        self.pruned = 0
+
+    def add(self, operation):
+        object_type = operation.get('object_type')
+        client_id = operation.get('client_id')
+        if object_type == 'campaign' and operation.get('campaign_id'):
+            if is_remove(operation):
+                self.removed_campaigns.add((client_id, operation['campaign_id']))
+            elif is_add(operation):
+                self.added_campaigns.add((client_id, operation['campaign_id']))
+        elif object_type == 'adgroup' and operation.get('adgroup_id'):
+            if is_remove(operation):
+                self.removed_adgroups.add((client_id, operation['adgroup_id']))
+            elif is_add(operation):
+                self.added_adgroups.add((client_id, operation['adgroup_id']))
+            if operation.get('campaign_id'):
+                self.adgroup_campaigns[(client_id, operation['adgroup_id'])] = operation['campaign_id']
+
+    def _in_removed_campaign(self, client_id, operation):
+        if (client_id, operation.get('campaign_id')) in self.removed_campaigns:
+            return True
+        campaign_id = self.adgroup_campaigns.get((client_id, operation.get('adgroup_id')))
+        return campaign_id is not None and (client_id, campaign_id) in self.removed_campaigns
+
+    def is_redundant(self, operation):
+        object_type = operation.get('object_type')
+        client_id = operation.get('client_id')
+        if object_type == 'campaign':
+            redundant = ((client_id, operation.get('campaign_id')) in self.removed_campaigns
+                         and (not is_remove(operation)
+                              or (client_id, operation.get('campaign_id')) in self.added_campaigns))
+        elif object_type == 'adgroup':
+            adgroup = (client_id, operation.get('adgroup_id'))
+            redundant = (self._in_removed_campaign(client_id, operation)
+                         or (adgroup in self.removed_adgroups
+                             and (not is_remove(operation) or adgroup in self.added_adgroups)))
+        else:
+            redundant = (self._in_removed_campaign(client_id, operation)
+                         or (client_id, operation.get('adgroup_id')) in self.removed_adgroups)
+        if redundant:
+            self.pruned += 1
+        return redundant
@@ -0,0 +1,57 @@
+from functools import lru_cache
+
+from .mappers import FIELD_MAP, MAPPERS, OPERATIONS_MAP
+
+# casting function of each field, the fields without one (Identity) are kept as they are
+_CASTERS = {name: MAPPERS[mapper].to_adwords for name, mapper in FIELD_MAP.items() if mapper != 'Identity'}
+
+
+class Record(dict):
+    """
+    Internal operation of a given object_type with its values already cast to AdWords
+
+    Values are cast once, with the `cast_to_adwords` of each field, and fields with a None value are left
+    out, like `OperationsBuilder.filter_operation` does. Records are dicts without instance attributes, so
+    the builder and the operation functions take them as they are and `**record` is as cheap as for a
+    plain dict.
+    """
+    __slots__ = ()
+    object_type = None
+
+    def __init__(self, entry):
+        super().__init__()
+        # the items are set through dict, the object_type check of __setitem__ is only for later changes
+        set_item = dict.__setitem__
+        for name, value in entry.items():
+            if name in _CASTERS:
+                value = _CASTERS[name](value)
+            if value is not None:
+                set_item(self, name, value)
+
+    def __setitem__(self, name, value):
+        if name == 'object_type' and self.object_type is not None:
+            raise KeyError('The object_type of a record can not be changed')
+        super().__setitem__(name, value)
+
+
+@lru_cache()
+def get_record_class(object_type):
+    """
+    Record class of an object_type, the base Record for the object_types without operation functions
+
+    >>> get_record_class('keyword').__name__
+    'KeywordRecord'
+    """
+    if object_type not in OPERATIONS_MAP:
+        return Record
+    name = ''.join(part.title() for part in object_type.split('_')) + 'Record'
+    return type(name, (Record,), {'__slots__': (), 'object_type': object_type})
+
+
+def make_record(entry):
+    """
+    Record of an internal operation (a dict), casting its values once
+    """
+    if isinstance(entry, Record):
+        return entry
+    return get_record_class(entry.get('object_type'))(entry)
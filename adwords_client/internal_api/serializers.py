@@ -0,0 +1,260 @@
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .mappers import OPERATIONS_MAP, COMMON_FIELDS, get_object_type_fields
+
+_LENGTH = struct.Struct('<I')
+_HEADER = struct.Struct('<HB')
+_LONG = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+_INT_SLOT = struct.Struct('<BBq')
+_FLOAT_SLOT = struct.Struct('<BBd')
+_STR_SLOT = struct.Struct('<BBI')
+
+# Value tags of the binary record format
+_NONE = 1
+_TRUE = 2
+_FALSE = 3
+_INT = 4
+_FLOAT = 5
+_STR = 6
+_JSON = 7
+
+_MIN_LONG = -2 ** 63
+_MAX_LONG = 2 ** 63 - 1
+
+
+class JsonSerializer:
+    """
+    One JSON document per line, the default format of the operations buffer
+    """
+    name = 'json'
+    # every entry is a single line, so files can be read from any line boundary
+    line_based = True
+
+    def dumps(self, entry):
+        return json.dumps(entry).encode('utf-8') + b'\n'
+
+    def dump(self, entry, file):
+        file.write(self.dumps(entry))
+
+    def loads(self, line):
+        return json.loads(line.decode('utf-8'))
+
+    def load(self, file):
+        for line in file:
+            yield self.loads(line)
+
+
+class RecordSchema:
+    def __init__(self, schema_id, object_type, fields):
+        self.schema_id = schema_id
+        self.object_type = object_type
+        self.fields = tuple(fields)
+        if len(self.fields) > 255:
+            raise ValueError('Too many fields for object_type {}'.format(object_type))
+        self.slots = {field: slot for slot, field in enumerate(self.fields)}
+        self.header = struct.pack('<H', schema_id)
+
+
+class BinarySerializer:
+    """
+    Length prefixed binary records with one schema per object_type
+
+    Every record is a 4 bytes length followed by the payload. The payload starts with the schema id and
+    the number of schema fields present in the entry, followed by a (slot, tag, value) triple for each one
+    of them. Fields that are not in the schema go at the end of the payload as a JSON object, so any entry
+    can be stored.
+    """
+    name = 'binary'
+
+    def __init__(self):
+        # schema 0 is used by entries with an unknown object_type and keeps it as a regular field
+        generic = RecordSchema(0, None, list(COMMON_FIELDS) + ['object_type'])
+        self.schemas = [generic]
+        self.schemas_by_object_type = {}
+        for object_type in sorted(OPERATIONS_MAP):
+            fields = list(get_object_type_fields(object_type))
+            schema = RecordSchema(len(self.schemas), object_type, fields)
+            self.schemas.append(schema)
+            self.schemas_by_object_type[object_type] = schema
+
+    def dumps(self, entry):
+        return self.encode(entry)
+
+    def dump(self, entry, file):
+        file.write(self.encode(entry))
+
+    def load(self, file):
+        read = file.read
+        while True:
+            header = read(_LENGTH.size)
+            if not header:
+                break
+            if len(header) < _LENGTH.size:
+                raise ValueError('Truncated binary record header')
+            size, = _LENGTH.unpack(header)
+            payload = read(size)
+            if len(payload) < size:
+                raise ValueError('Truncated binary record')
+            yield self.decode(payload)
+
+    def encode(self, entry):
+        schema = self.schemas_by_object_type.get(entry.get('object_type'), self.schemas[0])
+        slots = schema.slots
+        parts = [schema.header]
+        extra = None
+        count = 0
+        for field, value in entry.items():
+            slot = slots.get(field)
+            if slot is None:
+                if field != 'object_type' or schema.object_type is None:
+                    if extra is None:
+                        extra = {}
+                    extra[field] = value
+                continue
+            count += 1
+            if value is None:
+                parts.append(bytes((slot, _NONE)))
+            elif value is True:
+                parts.append(bytes((slot, _TRUE)))
+            elif value is False:
+                parts.append(bytes((slot, _FALSE)))
+            elif type(value) is int and _MIN_LONG <= value <= _MAX_LONG:
+                parts.append(_INT_SLOT.pack(slot, _INT, value))
+            elif type(value) is float:
+                parts.append(_FLOAT_SLOT.pack(slot, _FLOAT, value))
+            elif type(value) is str:
+                value = value.encode('utf-8')
+                parts.append(_STR_SLOT.pack(slot, _STR, len(value)))
+                parts.append(value)
+            else:
+                value = json.dumps(value).encode('utf-8')
+                parts.append(_STR_SLOT.pack(slot, _JSON, len(value)))
+                parts.append(value)
+        parts[0] = schema.header + bytes((count,))
+        if extra:
+            parts.append(json.dumps(extra).encode('utf-8'))
+        payload = b''.join(parts)
+        return _LENGTH.pack(len(payload)) + payload
+
+    def decode(self, payload):
+        schema_id, count = _HEADER.unpack_from(payload)
+        schema = self.schemas[schema_id]
+        fields = schema.fields
+        entry = {}
+        if schema.object_type is not None:
+            entry['object_type'] = schema.object_type
+        offset = _HEADER.size
+        for _ in range(count):
+            field = fields[payload[offset]]
+            tag = payload[offset + 1]
+            offset += 2
+            if tag == _INT:
+                entry[field], = _LONG.unpack_from(payload, offset)
+                offset += _LONG.size
+            elif tag == _FLOAT:
+                entry[field], = _DOUBLE.unpack_from(payload, offset)
+                offset += _DOUBLE.size
+            elif tag == _STR or tag == _JSON:
+                size, = _LENGTH.unpack_from(payload, offset)
+                offset += _LENGTH.size
+                value = payload[offset:offset + size].decode('utf-8')
+                entry[field] = value if tag == _STR else json.loads(value)
+                offset += size
+            elif tag == _NONE:
+                entry[field] = None
+            elif tag == _TRUE:
+                entry[field] = True
+            elif tag == _FALSE:
+                entry[field] = False
+            else:
+                raise ValueError('Unknown binary record tag: {}'.format(tag))
+        if offset < len(payload):
+            entry.update(json.loads(payload[offset:].decode('utf-8')))
+        return entry
+
+
+class OrjsonSerializer(JsonSerializer):
+    """
+    JSON lines written and read with orjson, when it is installed
+
+    Entries orjson can not encode (eg.: integers over 64 bits) are written by the json module instead, on a line
+    starting with a space so they are also read back by it. Non finite floats are written as null.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError('The orjson serializer needs the orjson package')
+
+    def dumps(self, entry):
+        try:
+            return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return b' ' + super().dumps(entry)
+
+    def loads(self, line):
+        if line[:1] == b' ':
+            return json.loads(line.decode('utf-8'))
+        return orjson.loads(line)
+
+
+class MsgpackSerializer:
+    """
+    Stream of MessagePack maps, when msgpack is installed
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('The msgpack serializer needs the msgpack package')
+
+    def dumps(self, entry):
+        return msgpack.packb(entry, use_bin_type=True)
+
+    def dump(self, entry, file):
+        file.write(self.dumps(entry))
+
+    def load(self, file):
+        yield from msgpack.Unpacker(file, raw=False, strict_map_key=False)
+
+
+SERIALIZERS = {
+    'json': JsonSerializer,
+    'binary': BinarySerializer,
+    'orjson': OrjsonSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+# Picked by the `auto` serializer, fastest first
+FASTEST_SERIALIZERS = (
+    ('orjson', lambda: orjson is not None),
+    ('msgpack', lambda: msgpack is not None),
+    ('binary', lambda: True),
+)
+
+
+def get_serializer(serializer):
+    """
+    Serializer instance from its name, `auto` picks the fastest one available on this host. Other hosts may
+    pick another one, so the name of the picked serializer is what the manifest of an operations folder records.
+    """
+    if isinstance(serializer, str):
+        if serializer == 'auto':
+            serializer = next(name for name, available in FASTEST_SERIALIZERS if available())
+        try:
+            return SERIALIZERS[serializer]()
+        except KeyError:
+            raise ValueError('Unknown serializer: {}'.format(serializer))
+    return serializer
@@ -1,9 +1,13 @@
 import logging
 import tempfile
 import os
+from threading import Lock
 
 logger = logging.getLogger(__name__)
 
+# guards the lazy creation of temporary work directories, so threads share a single one
+_workdir_lock = Lock()
+
 
 class FilesystemStorage:
     """
@@ -19,6 +23,14 @@ class FilesystemStorage:
         os.makedirs(os.path.dirname(full_name), exist_ok=True)
         return open(full_name, mode=mode, *args, **kwargs)
 
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.workdir, name))
+
+    def delete(self, name):
+        full_name = os.path.join(self.workdir, name)
+        if os.path.exists(full_name):
+            os.remove(full_name)
+
     def listdir(self, path):
         dirnames, filenames = [], []
         for _, dirnames, filenames in os.walk(os.path.join(self.workdir, path)):
@@ -36,5 +48,21 @@ class TemporaryFilesystemStorage(FilesystemStorage):
     @property
     def workdir(self):
         if not self._workdir:
-            self._workdir = tempfile.TemporaryDirectory()
+            with _workdir_lock:
+                if not self._workdir:
+                    self._workdir = tempfile.TemporaryDirectory()
         return self._workdir.name
+
+
+def is_local(storage):
+    """
+    Whether the files of a storage are local files, that can be reopened in append mode. Django storages
+    are local when they give the path of their files, remote ones (like S3) do not.
+    """
+    if isinstance(storage, FilesystemStorage):
+        return True
+    try:
+        storage.path('')
+    except (AttributeError, NotImplementedError):
+        return False
+    return True
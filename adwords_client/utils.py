@@ -1,8 +1,13 @@
+import io
 import logging
 import csv
+import lzma
+import shutil
 import tempfile
 import gzip
 from collections import OrderedDict
+from os import makedirs, path
+from itertools import islice
 
 
 logger = logging.getLogger(__name__)
@@ -18,6 +23,179 @@ def gunzip(compressed_stream):
     return decompressed_file
 
 
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'lzma': '.xz',
+}
+
+
+def compression_stream(file, compression, mode='rb'):
+    """
+    Binary stream that (de)compresses the data of `file`. Closing it does not close `file`.
+    Writing to a file that already has data appends a new gzip member (or xz stream), both formats
+    read concatenated members back as a single stream.
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file, mode=mode, compresslevel=6)
+    elif compression == 'lzma':
+        return lzma.LZMAFile(file, mode=mode)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def read_lines(file, size):
+    """
+    Lines of a binary file from its current position, until `size` bytes are read
+    """
+    for line in file:
+        yield line
+        size -= len(line)
+        if size <= 0:
+            break
+
+
+def compressed_name(name, compression):
+    return name + COMPRESSION_SUFFIXES[compression] if compression else name
+
+
+def uncompressed_name(name):
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def open_storage_file(storage, name, mode='r', compression=None):
+    """
+    Opens a file of the storage, (de)compressing it on the fly when a compression is given. The file name
+    gets the suffix of the compression.
+    """
+    if compression:
+        file_mode = mode.replace('+', '').replace('b', '') + 'b'
+        file = storage.open(compressed_name(name, compression), mode=file_mode)
+        return CompressedFile(file, compression, mode)
+    return storage.open(name, mode=mode)
+
+
+def add_file_stats(files, file_name, entry, size):
+    """
+    Adds an entry of `size` serialized bytes to the manifest stats of `file_name`
+    """
+    stats = files.get(file_name)
+    if stats is None:
+        stats = files[file_name] = {'client_ids': [], 'operations': {}, 'bytes': 0}
+    if entry['client_id'] not in stats['client_ids']:
+        stats['client_ids'].append(entry['client_id'])
+    object_type = entry.get('object_type')
+    stats['operations'][object_type] = stats['operations'].get(object_type, 0) + 1
+    stats['bytes'] += size
+
+
+class CompressedFile:
+    """
+    File like object over a compressed storage file, that is closed along with it
+    """
+    def __init__(self, file, compression, mode='r'):
+        self.raw = file
+        stream = compression_stream(file, compression, 'rb' if 'r' in mode else 'wb')
+        self.stream = stream if 'b' in mode else io.TextIOWrapper(stream, encoding='utf-8')
+
+    def __getattr__(self, item):
+        return getattr(self.stream, item)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        self.stream.close()
+        self.raw.close()
+
+
+class FilePool:
+    """
+    Writes to many files keeping at most `max_open` of them open, the least recently used one is closed
+    when a new file must be opened and is reopened in append mode if it gets more data later.
+
+    Writes are buffered per file and only reach the files when the pool buffers more than `max_buffered`
+    bytes, so each file gets a few big writes instead of one per entry. `open_file(name, mode)` is used
+    to open the files, in 'wb' mode the first time and in 'ab' mode afterwards.
+
+    Storages that can not open files in append mode (see `storages.is_local`) take `append=False`: the
+    files are written to local spool files instead, and each one is written to `open_file` once, in 'wb'
+    mode, when the pool is closed.
+    """
+    def __init__(self, open_file, max_open=256, max_buffered=8 * 1024 * 1024, append=True):
+        self.open_file = open_file
+        self.max_open = max_open
+        self.max_buffered = max_buffered
+        self.files = OrderedDict()
+        self.pending = OrderedDict()
+        self.buffered = 0
+        # every file opened by the pool, in the order they were created
+        self.created = OrderedDict()
+        self.evictions = 0
+        self.spool = None if append else tempfile.TemporaryDirectory()
+        # spooled files written since they were last copied to `open_file`
+        self.spooled = OrderedDict()
+
+    def write(self, name, data):
+        pending = self.pending.get(name)
+        if pending is None:
+            pending = self.pending[name] = []
+        pending.append(data)
+        self.buffered += len(data)
+        if self.buffered > self.max_buffered:
+            self.flush()
+
+    def _get_file(self, name):
+        file = self.files.get(name)
+        if file is not None:
+            self.files.move_to_end(name)
+            return file
+        while len(self.files) >= self.max_open:
+            _, evicted = self.files.popitem(last=False)
+            evicted.close()
+            self.evictions += 1
+        mode = 'ab' if name in self.created else 'wb'
+        if self.spool is None:
+            file = self.open_file(name, mode)
+        else:
+            spool_name = path.join(self.spool.name, name)
+            makedirs(path.dirname(spool_name), exist_ok=True)
+            file = open(spool_name, mode)
+            self.spooled[name] = True
+        self.files[name] = file
+        self.created[name] = True
+        return file
+
+    def _copy_spooled(self):
+        while self.spooled:
+            name, _ = self.spooled.popitem(last=False)
+            file = self.open_file(name, 'wb')
+            try:
+                with open(path.join(self.spool.name, name), 'rb') as spooled:
+                    shutil.copyfileobj(spooled, file, 1024 * 1024)
+            finally:
+                file.close()
+
+    def flush(self):
+        # files that are already open go first, so they are not evicted before being written
+        names = sorted(self.pending, key=lambda name: name not in self.files)
+        for name in names:
+            self._get_file(name).write(b''.join(self.pending.pop(name)))
+        self.buffered = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            while self.files:
+                _, file = self.files.popitem()
+                file.close()
+        if self.spool is not None:
+            # the spool files are kept, a file written after this is copied again with all of its data
+            self._copy_spooled()
+
+
 def csv_reader(data_stream, fields, converter=None):
     if converter:
         converter = [converter.get(field, lambda x: x) for field in fields]
@@ -27,3 +205,11 @@ def csv_reader(data_stream, fields, converter=None):
             yield OrderedDict(zip(fields, map(lambda x, y: x(y), converter, line)))
 
     return fields_iterator
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
@@ -1,10 +1,17 @@
 import logging
+from io import BytesIO
+from collections import OrderedDict
 from pprint import pprint
+from types import SimpleNamespace
 import hashlib
+import json
+import os
+import threading
 
 from adwords_client.client import AdWords
 from adwords_client import reports
 from adwords_client.internal_api.builder import OperationsBuilder
+from adwords_client.internal_api.serializers import get_serializer
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
@@ -1189,6 +1196,1329 @@ def test_build_adwords_operations():
     _build_user_list_operation()
 
 
+def _buffer_entries():
+    return [
+        {
+            'object_type': 'campaign',
+            'client_id': 7857288943,
+            'campaign_id': -1,
+            'budget': 1000,
+            'campaign_name': 'API test campaign ção',
+            'locations': [1001773, 1001768],
+            'status': 'PAUSED',
+        },
+        {
+            'object_type': 'keyword',
+            'client_id': '7857288943',
+            'campaign_id': -1,
+            'adgroup_id': -2,
+            'text': 'my search term',
+            'cpc_bid': 13.37,
+            'status': None,
+            'extra_field': {'nested': [1, 2.5, True]},
+        },
+        {
+            'object_type': 'unknown_type',
+            'client_id': 2 ** 70,
+            'is_negative': False,
+        },
+        {
+            'client_id': 7857288943,
+        },
+    ]
+
+
+def _serialize_operations(serializer_name):
+    from io import BytesIO
+    serializer = get_serializer(serializer_name)
+    file = BytesIO()
+    for entry in _buffer_entries():
+        serializer.dump(entry, file)
+    file.seek(0)
+    assert list(serializer.load(file)) == _buffer_entries()
+
+    client = AdWords(serializer=serializer_name)
+    client.insert(_buffer_entries()[:2])
+    assert list(client._read_buffer()) == _buffer_entries()[:2]
+
+    # storage files are written with the same serializer
+    entries = [dict(entry, campaign_id=1001) for entry in _buffer_entries()]
+    client = AdWords(serializer=serializer_name)
+    client.insert(entries)
+    operations_folder = client.split()
+    assert list(client._read_from_folder(operations_folder)) == entries
+
+
+def _spool_operations():
+    client = AdWords(buffer_max_rows=2)
+    client.insert(_buffer_entries()[:2])
+    assert not client.operations.spilled
+    client.insert(_buffer_entries()[2:])
+    assert client.operations.spilled
+    assert list(client._read_buffer()) == _buffer_entries()
+
+    client = AdWords(buffer_max_size=1024 * 1024)
+    client.insert(_buffer_entries())
+    assert not client.operations.spilled
+    assert list(client._read_buffer()) == _buffer_entries()
+
+
+def _track_min_id():
+    client = AdWords()
+    client.insert(_buffer_entries())
+    assert client.min_id == -2
+    client.insert({
+        'object_type': 'adgroup',
+        'client_id': 7857288943,
+        'campaign_id': -1,
+        'adgroup_id': -7.0,
+        'adgroup_name': '-100',
+        'cpc_bid': -100,
+    })
+    assert client.min_id == -7
+
+
+def _insert_files():
+    from io import StringIO
+    csv_data = StringIO(
+        'client_id,campaign_id,adgroup_id,criteria_id,cpc_bid,text,operator\n'
+        '7857288943,1001,-2,,4.20,my search term,ADD\n'
+        '7857288943,1001,2002,3003,0.35,,SET\n'
+    )
+    client = AdWords()
+    assert client.insert_csv(csv_data, chunk_size=1, defaults={'object_type': 'keyword'}) == 2
+    assert list(client._read_buffer()) == [
+        {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': 1001, 'adgroup_id': -2,
+         'cpc_bid': 4.2, 'text': 'my search term', 'operator': 'ADD'},
+        {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': 1001, 'adgroup_id': 2002,
+         'criteria_id': 3003, 'cpc_bid': 0.35, 'operator': 'SET'},
+    ]
+    assert client.min_id == -2
+
+    # the columns are parsed with the types of the object_type of each row
+    csv_data = StringIO(
+        'object_type,client_id,shared_set_id,shared_set_name,label_id,campaign_id\n'
+        'shared_set,7857288943,-7,negatives,,\n'
+        'attach_label,7857288943,,,-9,1001\n'
+    )
+    client = AdWords()
+    assert client.insert_csv(csv_data) == 2
+    assert list(client._read_buffer()) == [
+        {'object_type': 'shared_set', 'client_id': 7857288943, 'shared_set_id': -7, 'shared_set_name': 'negatives'},
+        {'object_type': 'attach_label', 'client_id': 7857288943, 'label_id': -9, 'campaign_id': 1001},
+    ]
+    assert client.min_id == -9
+
+    # values that can not be parsed tell where they are
+    csv_data = StringIO(
+        'client_id,campaign_id,label_id\n'
+        '7857288943,1001,9\n'
+        '7857288943,12.0,9\n'
+    )
+    try:
+        AdWords().insert_csv(csv_data, defaults={'object_type': 'attach_label'})
+    except ValueError as e:
+        assert str(e).startswith("Invalid value '12.0' for column campaign_id at line 3")
+    else:
+        raise AssertionError('unparseable values must be reported')
+
+    jsonl_data = StringIO('\n'.join(json.dumps(entry) for entry in _buffer_entries()))
+    client = AdWords(serializer='binary')
+    assert client.insert_file(jsonl_data, 'jsonl') == len(_buffer_entries())
+    assert list(client._read_buffer()) == _buffer_entries()
+
+
+def _compress_operations(compression, serializer):
+    client = AdWords(compression=compression, serializer=serializer, buffer_max_rows=2)
+    assert list(client._read_buffer()) == []
+    client.insert(_buffer_entries()[:2])
+    assert list(client._read_buffer()) == _buffer_entries()[:2]
+    # writing after a read appends a new compressed member
+    client.insert(_buffer_entries()[2:])
+    assert list(client._read_buffer()) == _buffer_entries()
+
+    entries = [dict(entry, campaign_id=1001) for entry in _buffer_entries()]
+    client = AdWords(compression=compression)
+    client.insert(entries)
+    operations_folder = client.split()
+    _, files = client.storage.listdir(operations_folder)
+    assert sorted(files) == ['1001.data' + {'gzip': '.gz', 'lzma': '.xz'}[compression], 'manifest.json']
+    assert list(client._read_from_folder(operations_folder)) == entries
+
+
+def _durable_operations(workdir, compression):
+    client = AdWords(workdir=workdir, buffer_name='ingest', buffer_commit_every=2, compression=compression)
+    client.insert(_buffer_entries()[:3])
+    # the process "dies" without closing the buffer, only the first commit survives
+    client = AdWords(workdir=workdir, buffer_name='ingest', buffer_commit_every=2, compression=compression)
+    assert client.operations.rows == 2
+    assert client.min_id == -2
+    client.insert(_buffer_entries()[2:])
+    client.operations.close()
+
+    client = AdWords(workdir=workdir, buffer_name='ingest', compression=compression)
+    assert list(client._read_buffer()) == _buffer_entries()
+    client.operations.discard()
+    client = AdWords(workdir=workdir, buffer_name='ingest', compression=compression)
+    assert list(client._read_buffer()) == []
+
+
+def _concurrent_insert(workdir):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _entries(thread):
+        return [{'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': thread,
+                 'adgroup_id': -thread * 1000 - i, 'cpc_bid': 1.0} for i in range(500)]
+
+    client = AdWords(workdir=workdir, concurrent_insert=True, buffer_name='ingest', buffer_commit_every=100)
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda thread: client.insert(_entries(thread)), range(1, 9)))
+    assert client.min_id == -8499
+    client.operations.close()
+
+    client = AdWords(workdir=workdir, concurrent_insert=True, buffer_name='ingest')
+    entries = list(client._read_buffer())
+    assert client.min_id == -8499
+    assert len(entries) == 8 * 500
+    for thread in range(1, 9):
+        assert [entry for entry in entries if entry['campaign_id'] == thread] == _entries(thread)
+
+
+def _coalesce_operations():
+    client = AdWords()
+    keyword = {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': 1001, 'adgroup_id': 2002}
+    client.insert([
+        dict(keyword, criteria_id=3003, cpc_bid=1.0, operator='SET'),
+        {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'adgroup_name': 'new adgroup'},
+        dict(keyword, criteria_id=3004, operator='SET', status='PAUSED'),
+        dict(keyword, criteria_id=3003, operator='SET', status='PAUSED'),
+        {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'operator': 'SET', 'cpc_bid': 2.0},
+        dict(keyword, criteria_id=3004, operator='REMOVE'),
+        {'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': -5, 'campaign_name': 'temp'},
+        {'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': -5, 'operator': 'REMOVE'},
+        dict(keyword, text='new keyword', keyword_match_type='EXACT'),
+    ])
+    assert client.coalesce() == 5
+    assert list(client._read_buffer()) == [
+        dict(keyword, criteria_id=3003, cpc_bid=1.0, operator='SET', status='PAUSED'),
+        {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'adgroup_name': 'new adgroup', 'operator': 'ADD', 'cpc_bid': 2.0},
+        dict(keyword, criteria_id=3004, operator='REMOVE'),
+        dict(keyword, text='new keyword', keyword_match_type='EXACT'),
+    ]
+    assert client.min_id == -5
+
+    # a REMOVE stays after the operations using the entity
+    client = AdWords()
+    adgroup = {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': 1001, 'adgroup_id': 20}
+    new_keyword = dict(keyword, adgroup_id=20, text='new keyword', keyword_match_type='EXACT')
+    client.insert([dict(adgroup, operator='SET', cpc_bid=1.0), new_keyword, dict(adgroup, operator='REMOVE')])
+    assert client.coalesce() == 1
+    assert list(client._read_buffer()) == [new_keyword, dict(adgroup, operator='REMOVE')]
+
+    # the operations on a campaign or ad group that is added and removed are dropped with it
+    client = AdWords()
+    campaign = {'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': -5}
+    temp_adgroup = {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -5, 'adgroup_id': -6}
+    client.insert([
+        dict(campaign, campaign_name='temp'),
+        dict(temp_adgroup, adgroup_name='temp'),
+        {'object_type': 'keyword', 'client_id': 7857288943, 'adgroup_id': -6, 'text': 'a'},
+        dict(adgroup, adgroup_id=-7, adgroup_name='temp'),
+        {'object_type': 'keyword', 'client_id': 7857288943, 'adgroup_id': -7, 'text': 'b'},
+        new_keyword,
+        dict(campaign, operator='REMOVE'),
+        dict(adgroup, adgroup_id=-7, operator='REMOVE'),
+        {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': -5, 'adgroup_id': -6, 'text': 'c'},
+        dict(temp_adgroup, adgroup_id=-8, adgroup_name='late'),
+        {'object_type': 'keyword', 'client_id': 7857288943, 'adgroup_id': -8, 'text': 'd'},
+    ])
+    assert client.coalesce() == 10
+    assert list(client._read_buffer()) == [new_keyword]
+
+    # campaigns and ad groups are removed with a SET of the REMOVED status
+    client = AdWords()
+    client.insert([
+        dict(campaign, campaign_name='temp'),
+        dict(temp_adgroup, adgroup_name='temp'),
+        {'object_type': 'keyword', 'client_id': 7857288943, 'adgroup_id': -6, 'text': 'a'},
+        new_keyword,
+        dict(campaign, operator='SET', status='REMOVED'),
+    ])
+    assert client.coalesce() == 4
+    assert list(client._read_buffer()) == [new_keyword]
+
+
+class _FakeUploadHelper:
+    def __init__(self, job_id=None):
+        self.operations = OrderedDict()
+        self.uploads = []
+        # (thread, has_prefix) of each serialized chunk and thread of each upload
+        self.serialized = []
+        self.uploaded = []
+        self.fail = False
+        self.fail_after = None
+        self.chunker = None
+        self.uploaded_operations = 0
+        self.on_upload = None
+        self.job_id = job_id
+
+    def add_operation(self, operation):
+        self.operations.setdefault(operation['xsi_type'], []).append(operation)
+
+    def take_operations(self):
+        operations = list(self.operations.values())
+        self.operations = OrderedDict()
+        return operations
+
+    def upload(self, operations, is_last=False):
+        self.upload_body(self.serialize(operations, is_last), operations, is_last)
+
+    def serialize(self, operations, is_last=False, has_prefix=None):
+        if has_prefix is None:
+            has_prefix = self.uploaded_operations == 0
+        self.serialized.append((threading.current_thread(), has_prefix))
+        return json.dumps(operations)
+
+    def upload_body(self, body, operations, is_last=False):
+        if self.fail or (self.fail_after is not None and len(self.uploads) >= self.fail_after):
+            raise RuntimeError('upload failed')
+        assert json.loads(body) == operations
+        self.uploaded.append(threading.current_thread())
+        self.uploads.append(([op for ops in operations for op in ops], is_last))
+        self.uploaded_operations += len(self.uploads[-1][0])
+        if self.on_upload:
+            self.on_upload(self.checkpoint(is_last))
+
+    def operations_xml(self, operations):
+        return _reference_operations_xml(operations)
+
+    def checkpoint(self, is_last=False):
+        return {'uploaded_operations': self.uploaded_operations,
+                'resume_url': 'https://upload/{}/session'.format(self.job_id),
+                'content_length': 100 * self.uploaded_operations, 'is_last': is_last}
+
+    def upload_operations(self, is_last=False):
+        self.upload(self.take_operations(), is_last)
+
+
+class _FakeBatchJobService:
+    def __init__(self):
+        self.client = SimpleNamespace(client_customer_id=None)
+        self.jobs = []
+        self.resumed = []
+        self.batch_job = None
+        self.helper = None
+
+    def prepare_job(self, client_customer_id=None):
+        job_id = len(self.jobs) + 1
+        self.client.client_customer_id = client_customer_id
+        batch_job = SimpleNamespace(id=job_id, status='ACTIVE',
+                                    uploadUrl=SimpleNamespace(url='https://upload/{}'.format(job_id)))
+        self.batch_job = SimpleNamespace(result={'value': [batch_job]})
+        self.helper = _FakeUploadHelper(job_id)
+        self.jobs.append((client_customer_id, self.helper))
+
+    def resume_job(self, client_customer_id, checkpoint):
+        self.client.client_customer_id = client_customer_id
+        self.batch_job = None
+        self.helper = _FakeUploadHelper(checkpoint['batchjob_id'])
+        self.helper.uploaded_operations = checkpoint.get('uploaded_operations', 0)
+        self.jobs.append((client_customer_id, self.helper))
+        self.resumed.append(checkpoint)
+
+
+def _update_bids():
+    from array import array
+    operation_builder = OperationsBuilder()
+    keyword_operation = next(operation_builder({
+        'object_type': 'keyword', 'client_id': 7857288943, 'adgroup_id': 2002, 'criteria_id': 3003,
+        'cpc_bid': 4.20, 'operator': 'SET',
+    }))
+    adgroup_operation = next(operation_builder({
+        'object_type': 'adgroup', 'client_id': 7857288943, 'adgroup_id': 2002, 'cpc_bid': 0.35, 'operator': 'SET',
+    }))
+    del adgroup_operation['operand']['campaignId']
+
+    client = AdWords()
+    bjs = client.services['BatchJobService'] = _FakeBatchJobService()
+    operations_folder = client.update_bids(
+        [7857288943, 7857288943, 1234567890, 1234567890],
+        array('q', [2002, 2002, 2002, 2002]),
+        [3003, None, 3003, 3003],
+        array('d', [4.20, 0.35, 4.20, float('nan')]),
+    )
+    assert [client_id for client_id, _ in bjs.jobs] == [7857288943, 1234567890]
+    assert bjs.jobs[0][1].uploads == [([keyword_operation, adgroup_operation], True)]
+    assert bjs.jobs[1][1].uploads == [([keyword_operation], True)]
+    _, files = client.storage.listdir(operations_folder)
+    assert sorted(files) == ['1234567890.bids.result', '7857288943.bids.result']
+    try:
+        client.update_bids([7857288943, 7857288943], [2002, 2002], None, [4.20])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('sequences of different lengths must not be truncated')
+
+
+def _pipelined_uploads():
+    import adwords_client.client
+    entries = [{'object_type': 'label', 'client_id': client_id, 'label': 'label {}'.format(index)}
+               for client_id in [7857288943, 1234567890] for index in range(7)]
+
+    def run(upload_queue_size, fail=False):
+        client = AdWords(upload_queue_size=upload_queue_size)
+        bjs = client.services['BatchJobService'] = _FakeBatchJobService()
+        prepare_job = bjs.prepare_job
+
+        def failing_prepare_job(client_customer_id=None):
+            prepare_job(client_customer_id)
+            bjs.helper.fail = fail
+        bjs.prepare_job = failing_prepare_job
+        for entry in entries:
+            client._write_entry('labels.data', entry)
+        client._batch_operations('labels.data')
+        return [(client_id, helper.uploads) for client_id, helper in bjs.jobs]
+
+    batch_size = adwords_client.client.BATCH_SIZE
+    adwords_client.client.BATCH_SIZE = 3
+    try:
+        serial = run(None)
+        assert [client_id for client_id, _ in serial] == [7857288943, 1234567890]
+        assert [[(len(operations), is_last) for operations, is_last in uploads] for _, uploads in serial] == \
+            [[(3, False), (3, False), (1, True)]] * 2
+        assert run(1) == serial
+        assert run(4) == serial
+        # the chunks are serialized and uploaded on two threads, other than the one building them
+        client = AdWords(upload_queue_size=1)
+        bjs = client.services['BatchJobService'] = _FakeBatchJobService()
+        for entry in entries:
+            client._write_entry('labels.data', entry)
+        client._batch_operations('labels.data')
+        helper = bjs.jobs[0][1]
+        assert [has_prefix for _, has_prefix in helper.serialized] == [True, False, False]
+        threads = {thread for thread, _ in helper.serialized}, set(helper.uploaded)
+        assert [len(stage) for stage in threads] == [1, 1]
+        assert len(threads[0] | threads[1] | {threading.current_thread()}) == 3
+        try:
+            run(1, fail=True)
+        except RuntimeError as e:
+            assert str(e) == 'upload failed'
+        else:
+            raise AssertionError('upload errors must reach the caller')
+    finally:
+        adwords_client.client.BATCH_SIZE = batch_size
+
+    # closing the pipeline while handling another error does not replace it
+    from adwords_client.adwords_api.batch_job_service import UploadPipeline
+    helper = _FakeUploadHelper(1)
+    helper.fail = True
+    helper.add_operation({'xsi_type': 'LabelOperation'})
+    pipeline = UploadPipeline(helper)
+    pipeline.submit()
+    try:
+        try:
+            raise ValueError('building failed')
+        except ValueError as e:
+            pipeline.close(e)
+            raise
+    except ValueError as e:
+        assert str(e) == 'building failed'
+    assert isinstance(pipeline.error, RuntimeError)
+    try:
+        pipeline.close()
+    except RuntimeError as e:
+        assert str(e) == 'upload failed'
+    else:
+        raise AssertionError('upload errors must be raised when closing normally')
+
+    # a chunk that can not be serialized stops the uploads as well
+    helper = _FakeUploadHelper(1)
+    helper.serialize = lambda operations, is_last=False, has_prefix=None: 1 / 0
+    helper.add_operation({'xsi_type': 'LabelOperation'})
+    pipeline = UploadPipeline(helper)
+    pipeline.submit()
+    try:
+        pipeline.close()
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError('serialization errors must reach the caller')
+    assert helper.uploads == []
+
+
+def _chunk_uploads():
+    from adwords_client.adwords_api.batch_job_service import UploadChunker
+    from adwords_client.adwords_api.batch_job_xml import schemaless_operations_xml
+    chunker = UploadChunker(target_bytes=1000, max_bytes=1500, min_bytes=300, target_seconds=10)
+    operation = {'operand': 'x' * 56}
+    size = len(schemaless_operations_xml([operation]))
+    assert size == 100
+    assert [chunker.cut(operation) for _ in range(11)] == [False] * 10 + [True]
+    assert (chunker.operations, chunker.bytes) == (1, size)
+
+    # after the first operations of a kind, only one in sample_every is serialized, the others are averaged
+    sampler = UploadChunker(target_bytes=1000, exact_samples=2, sample_every=3)
+    small, big = {'operand': 'x'}, {'operand': 'x' * 11}
+    assert [sampler.estimate_size(item) for item in [small, big, big, big, big, big, big]] == \
+        [45, 55, 55, 52, 52, 55, 53]
+    assert sampler.estimate_size(dict(big, operator='SET')) == 79
+    # the operations of a job are measured as its helper writes them
+    sampler.start_job(lambda operations: 'x' * 10 * len(operations))
+    assert sampler.estimate_size(big) == 10
+    chunker.record(1)
+    assert chunker.target_bytes == 1250
+    chunker.record(1, is_last=True)
+    chunker.record(7)
+    assert chunker.target_bytes == 1250
+    chunker.record(1)
+    assert chunker.target_bytes == 1500
+    chunker.record(20)
+    assert chunker.target_bytes == 750
+    chunker.record(1, failed=True)
+    chunker.record(1, failed=True)
+    assert (chunker.target_bytes, chunker.uploads, chunker.failures) == (300, 7, 2)
+    try:
+        UploadChunker(target_bytes=1000, max_bytes=500)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the upper bound must not be below the target')
+
+    # small operations fill bigger chunks than big ones
+    entries = [{'object_type': 'label', 'client_id': 7857288943, 'campaign_id': 1,
+                'label': 'label {}'.format(index)} for index in range(40)]
+    entries += [{'object_type': 'label', 'client_id': 1234567890, 'campaign_id': 2,
+                 'label': 'label {} {}'.format(index, 'x' * 200)} for index in range(40)]
+    client = AdWords(upload_chunk_bytes=2000)
+    bjs = client.services['BatchJobService'] = _FakeBatchJobService()
+    for entry in entries:
+        client._write_entry('labels.data', entry)
+    client._batch_operations('labels.data')
+    sizes = [[len(operations) for operations, _ in helper.uploads] for _, helper in bjs.jobs]
+    assert sum(sizes[0]) == sum(sizes[1]) == 40
+    assert len(sizes[0]) < len(sizes[1])
+    for _, helper in bjs.jobs:
+        assert all(len(_reference_operations_xml(operations)) <= 2000 for operations, _ in helper.uploads)
+
+    # without the API schema, plan measures slightly smaller operations and may count fewer uploads
+    client = AdWords(upload_chunk_bytes=2000)
+    client.insert(entries)
+    uploads = len(sizes[0]) + len(sizes[1])
+    assert uploads * 3 // 4 <= client.plan()['uploads'] <= uploads
+
+
+def _resume_uploads(workdir, compression, upload_queue_size=None):
+    import adwords_client.client
+    entries = [{'object_type': 'label', 'client_id': client_id, 'label': 'label {}'.format(index)}
+               for client_id in [7857288943, 1234567890] for index in range(7)]
+    client = AdWords(workdir=workdir, compression=compression)
+    for entry in entries:
+        client._write_entry('operations/labels.data', entry)
+    client.flush_files()
+
+    def run(fail_after=None, resume=True):
+        client = AdWords(workdir=workdir, compression=compression, upload_queue_size=upload_queue_size)
+        bjs = client.services['BatchJobService'] = _FakeBatchJobService()
+        prepare_job = bjs.prepare_job
+
+        def failing_prepare_job(client_customer_id=None):
+            prepare_job(client_customer_id)
+            if client_customer_id == 1234567890:
+                bjs.helper.fail_after = fail_after
+        bjs.prepare_job = failing_prepare_job
+        try:
+            client._batch_operations('operations/labels.data', resume=resume)
+        except RuntimeError:
+            pass
+        return client, bjs
+
+    def labels(helper):
+        return [[operation['operand']['name'] for operation in operations] for operations, _ in helper.uploads]
+
+    batch_size = adwords_client.client.BATCH_SIZE
+    adwords_client.client.BATCH_SIZE = 3
+    try:
+        # the second client fails after its first chunk
+        client, bjs = run(fail_after=1)
+        assert [len(helper.uploads) for _, helper in bjs.jobs] == [3, 1]
+        assert client._select_data_files('operations') == ['labels.data']
+        checkpoints = client._read_checkpoints('operations/labels.data.result')
+        assert [(entry['batchjob_id'], entry['uploaded_operations'], entry['is_last']) for entry in checkpoints] == \
+            [(1, 7, True), (2, 3, False)]
+        if compression:
+            # a process killed while writing leaves the compressed file without the end of the stream
+            with open(os.path.join(workdir, 'operations', 'labels.data.result.gz'), 'r+b') as file:
+                file.truncate(file.seek(0, os.SEEK_END) - 8)
+            assert client._read_checkpoints('operations/labels.data.result') == checkpoints
+
+        # the first job is skipped and the second one continues after its third operation
+        client, bjs = run()
+        assert [checkpoint['batchjob_id'] for checkpoint in bjs.resumed] == [2]
+        assert [client_id for client_id, _ in bjs.jobs] == [1234567890]
+        assert labels(bjs.jobs[0][1]) == [['label 3', 'label 4', 'label 5'], ['label 6']]
+        assert bjs.jobs[0][1].uploads[-1][1] is True
+        assert client._select_data_files('operations') == []
+        checkpoints = client._read_checkpoints('operations/labels.data.result')
+        assert [(entry['batchjob_id'], entry['uploaded_operations'], entry['is_last']) for entry in checkpoints] == \
+            [(1, 7, True), (2, 7, True)]
+        jobs = client._collect_jobs('operations')['pending']
+        assert sorted(jobs) == [1234567890, 7857288943]
+        assert client.plan('operations')['jobs'] == 0
+
+        # nothing left to resume, unless starting over
+        client, bjs = run()
+        assert bjs.jobs == []
+        client, bjs = run(resume=False)
+        assert [len(helper.uploads) for _, helper in bjs.jobs] == [3, 3]
+        assert client._select_data_files('operations', force_all=True) == ['labels.data']
+    finally:
+        adwords_client.client.BATCH_SIZE = batch_size
+
+
+def _resume_temporary_ids(workdir):
+    import adwords_client.client
+    entries = [{'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': -index, 'budget': 1000,
+                'campaign_name': 'campaign {}'.format(index)} for index in range(1, 5)]
+
+    def run(min_id, fail_after=None):
+        client = AdWords(workdir=workdir)
+        client.min_id = min_id
+        bjs = client.services['BatchJobService'] = _FakeBatchJobService()
+        prepare_job = bjs.prepare_job
+
+        def failing_prepare_job(client_customer_id=None):
+            prepare_job(client_customer_id)
+            bjs.helper.fail_after = fail_after
+        bjs.prepare_job = failing_prepare_job
+        try:
+            client._batch_operations('operations/campaigns.data')
+        except RuntimeError:
+            pass
+        return [operation['operand'].get('budgetId') or operation['operand']['budget']['budgetId']
+                for operations, _ in bjs.jobs[0][1].uploads for operation in operations]
+
+    client = AdWords(workdir=workdir)
+    for entry in entries:
+        client._write_entry('operations/campaigns.data', entry)
+    client.flush_files()
+    batch_size = adwords_client.client.BATCH_SIZE
+    adwords_client.client.BATCH_SIZE = 4
+    try:
+        # the budgets of the first run get ids below the -4 of the campaigns
+        assert run(-4, fail_after=1) == [-5, -6, -5, -6]
+        # a new process starts from 0, but resumes with the ids of the first run
+        assert run(0) == [-7, -8, -7, -8]
+    finally:
+        adwords_client.client.BATCH_SIZE = batch_size
+
+
+def _retry_policy():
+    import socket
+    import urllib.error
+    import googleads.errors
+    from adwords_client.adwords_api import common
+    delays = []
+    policy = common.RetryPolicy(max_retries=3, base_delay=1, rate_limit_delay=30, max_delay=20, jitter=0,
+                                sleep=delays.append)
+    rate_fault = googleads.errors.GoogleAdsServerFault(
+        None, [{'errorString': 'RateExceededError.RATE_EXCEEDED', 'retryAfterSeconds': 45}])
+    validation_fault = googleads.errors.GoogleAdsServerFault(None, [{'errorString': 'RequiredError.REQUIRED'}])
+    http_503 = urllib.error.HTTPError('https://upload', 503, 'Unavailable', {'Retry-After': '7'}, None)
+    http_400 = urllib.error.HTTPError('https://upload', 400, 'Bad Request', {}, None)
+    assert [policy.classify(error) for error in [rate_fault, validation_fault, http_503, http_400,
+                                                 socket.timeout(), ConnectionResetError(), ValueError()]] == \
+        [common.RATE_LIMIT, common.FATAL, common.TRANSIENT, common.FATAL,
+         common.TRANSIENT, common.TRANSIENT, common.FATAL]
+    assert [policy.get_delay(retry, socket.timeout()) for retry in range(6)] == [1, 2, 4, 8, 16, 20]
+    assert policy.get_delay(0, rate_fault) == 45
+    assert policy.get_delay(0, http_503) == 7
+    assert policy.get_delay(0, googleads.errors.GoogleAdsServerFault(
+        None, [{'errorString': 'RateExceededError.RATE_EXCEEDED'}])) == 20
+    jittered = common.RetryPolicy(base_delay=10, jitter=0.5)
+    assert all(5 <= jittered.get_delay(0, socket.timeout()) <= 10 for _ in range(20))
+
+    def flaky(errors):
+        def call(value):
+            if errors:
+                raise errors.pop(0)
+            return value
+        return call
+
+    assert policy.call(flaky([socket.timeout(), http_503]), 'done') == 'done'
+    assert delays == [1, 7]
+    for errors, expected_delays in [([validation_fault], []), ([socket.timeout()] * 4, [1, 2, 4])]:
+        del delays[:]
+        last_error = errors[-1]
+        try:
+            policy.call(flaky(errors), 'done')
+        except Exception as e:
+            assert e is last_error
+        else:
+            raise AssertionError('the error must reach the caller')
+        assert delays == expected_delays
+
+    # sync mutates share the policy of their service
+    del delays[:]
+    result = common.SyncReturnValue(SimpleNamespace(mutate=flaky([ConnectionResetError()])),
+                                    [{'operand': {}}], policy)
+    assert (result.result, delays) == ([{'operand': {}}], [1])
+    assert AdWords(retry_policy=policy).retry_policy is policy
+    assert AdWords().retry_policy is not policy
+
+
+def _reference_operations_xml(operations, calls=None):
+    # builds the XML of the operations like googleads does with zeep: fields in the order of the schema,
+    # the `.Type` fields of the types set by xsi_type and ElementTree's ASCII output
+    from xml.etree import ElementTree
+    schema = {
+        'Operation': ['operator', 'Operation.Type', 'operand'],
+        'Criterion': ['id', 'type', 'Criterion.Type'],
+        'Bids': ['Bids.Type', 'bid', 'cpcBidSource'],
+        'Ad': ['id', 'url', 'displayUrl', 'finalUrls', 'finalMobileUrls', 'type', 'Ad.Type'],
+    }
+    bases = {'Keyword': 'Criterion', 'Location': 'Criterion', 'Language': 'Criterion', 'CpcBid': 'Bids',
+             'ExpandedTextAd': 'Ad'}
+
+    def order(data):
+        xsi_type = data.get('xsi_type') or ''
+        base = 'Operation' if xsi_type.endswith('Operation') else bases.get(xsi_type)
+        fields = schema.get(base, [])
+        return fields + sorted(key for key in data if key not in fields and key != 'xsi_type')
+
+    def fill(element, data):
+        xsi_type = data.get('xsi_type')
+        if xsi_type:
+            element.set('{http://www.w3.org/2001/XMLSchema-instance}type', xsi_type)
+        for key in order(data):
+            value = xsi_type if key.endswith('.Type') and xsi_type else data.get(key)
+            for item in (value if isinstance(value, list) else [value]):
+                if item is None:
+                    continue
+                child = ElementTree.SubElement(element, key)
+                if isinstance(item, dict):
+                    fill(child, item)
+                else:
+                    child.text = 'true' if item is True else 'false' if item is False else str(item)
+
+    if calls is not None:
+        calls.append(len(operations))
+    xml = ''
+    for operation in operations:
+        element = ElementTree.Element('operations')
+        fill(element, operation)
+        xml += ElementTree.tostring(element).decode('utf-8')
+    return xml
+
+
+def _precompiled_xml():
+    from urllib.error import HTTPError
+    from adwords_client.adwords_api import common
+    from adwords_client.adwords_api.batch_job_service import BatchJobHelper
+    from adwords_client.adwords_api.batch_job_xml import BatchJobXmlSerializer
+
+    def golden_operations(suffix):
+        operation_builder = OperationsBuilder()
+        entries = [
+            {'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': -1, 'budget': 1000,
+             'campaign_name': 'Campanha & <teste> ' + suffix, 'locations': [1001773, 1001768],
+             'languages': [1014, 1000], 'status': 'PAUSED'},
+            {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+             'adgroup_name': 'Grupo de anúncios ' + suffix, 'cpc_bid': 13.37},
+            {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+             'text': 'pedreiro "barato" ' + suffix, 'keyword_match_type': 'broad', 'status': 'PAUSED',
+             'cpc_bid': 13.37},
+            {'object_type': 'keyword', 'client_id': 7857288943, 'adgroup_id': 2002, 'criteria_id': 3003,
+             'cpc_bid': 4.2, 'operator': 'SET'},
+            {'object_type': 'attach_label', 'client_id': 7857288943, 'campaign_id': 1001, 'label_id': 22},
+        ]
+        operations = OrderedDict()
+        for entry in entries:
+            for operation in operation_builder(entry):
+                operations.setdefault(operation['xsi_type'], []).append(operation)
+        return list(operations.values())
+
+    def googleads_body(operations):
+        return ''.join(_reference_operations_xml(operations_of_type) for operations_of_type in operations)
+
+    calls = []
+
+    def reference(operations):
+        return _reference_operations_xml(operations, calls)
+
+    serializer = BatchJobXmlSerializer()
+    first, second = golden_operations('1'), golden_operations('ação 2 & 3')
+    assert serializer.serialize(first, reference) == googleads_body(first).encode('utf-8')
+    compiled = len(calls)
+    assert compiled == len(serializer.templates) > 0
+    assert serializer.serialize(second, reference) == googleads_body(second).encode('utf-8')
+    assert b'a&#231;&#227;o 2 &amp; 3' in serializer.serialize(second, reference)
+    assert (len(calls), serializer.fallbacks) == (compiled, 0)
+
+    # shapes the reference writes differently are left to it
+    def unknown_fields(operations):
+        return reference(operations).replace('<operator>', '<extra /><operator>')
+
+    serializer = BatchJobXmlSerializer()
+    for _ in range(2):
+        assert serializer.serialize(first, unknown_fields) == googleads_body(first).replace(
+            '<operator>', '<extra /><operator>').encode('utf-8')
+    assert serializer.fallbacks == 2 * sum(len(operations_of_type) for operations_of_type in first) - len(
+        serializer.templates)
+    assert not any(serializer.templates.values())
+
+    # the chunk is serialized once and sent again as is after a transient error
+    class Opener:
+        def __init__(self):
+            self.requests = []
+
+        def open(self, request):
+            self.requests.append(request)
+            code = 503 if len(self.requests) == 1 else 308
+            raise HTTPError(request.full_url, code, 'status', {}, None)
+
+    fake_client = SimpleNamespace(proxy_config=SimpleNamespace(GetHandlers=lambda: []), custom_http_headers=None)
+    delays = []
+    bodies = []
+    for xml_serializer in [None, BatchJobXmlSerializer()]:
+        service = SimpleNamespace(client=fake_client, xml_serializer=xml_serializer,
+                                  retry_policy=common.RetryPolicy(jitter=0, sleep=delays.append))
+        helper = BatchJobHelper(service, 'https://upload/session', current_content_length=262144)
+        helper._request_builder._GenerateOperationsXML = reference
+        opener = helper.upload_helper._url_opener = Opener()
+        del calls[:]
+        helper.upload(first, is_last=True)
+        assert len(opener.requests) == 2 and opener.requests[0].data == opener.requests[1].data
+        request = opener.requests[1]
+        assert request.get_method() == 'PUT' and len(request.data) % 262144 == 0
+        assert request.get_header('Content-range') == 'bytes 262144-{0}/{1}'.format(
+            262144 + len(request.data) - 1, 262144 + len(request.data))
+        assert helper.checkpoint(True)['content_length'] == 262144 + len(request.data)
+        # one serialization for both attempts, through the templates after the first operation of each shape
+        if xml_serializer is None:
+            assert sum(calls) == sum(len(operations_of_type) for operations_of_type in first)
+        else:
+            assert sum(calls) == len(xml_serializer.templates)
+        bodies.append(request.data)
+    assert bodies[0] == bodies[1]
+    assert bodies[0].rstrip(b' ').endswith(b'</operations></mutate>')
+    assert delays == [1.0, 1.0]
+
+
+class _RemoteStorage:
+    """
+    Storage keeping its files in memory, which like remote Django storages (eg.: S3) has no paths and can not
+    open files in append mode
+    """
+    def __init__(self):
+        self.files = {}
+
+    def open(self, name, mode='rb'):
+        if 'a' in mode:
+            raise ValueError('Append mode is not supported')
+        if 'w' in mode:
+            storage = self
+
+            class RemoteFile(BytesIO):
+                def close(self):
+                    if not self.closed:
+                        storage.files[name] = self.getvalue()
+                    super().close()
+            return RemoteFile()
+        return BytesIO(self.files[name])
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def listdir(self, folder):
+        names = [name[len(folder) + 1:] for name in self.files if name.startswith(folder + '/')]
+        return sorted({name.split('/')[0] for name in names if '/' in name}), [name for name in names
+                                                                               if '/' not in name]
+
+    def path(self, name):
+        raise NotImplementedError("This backend doesn't support absolute paths.")
+
+
+def _split_operations(compression):
+    from adwords_client import utils
+    entries = [dict(entry, campaign_id=1000 + index % 5)
+               for index in range(20) for entry in _buffer_entries()[:1]]
+    client = AdWords(compression=compression)
+    client.insert(entries)
+    operations_folder = client.split(max_open_files=2)
+    _, files = client.storage.listdir(operations_folder)
+    assert len(files) == 6
+    for campaign_id in range(1000, 1005):
+        file_name = '{}/{}.data'.format(operations_folder, campaign_id)
+        assert list(client._read_entries(file_name)) == [entry for entry in entries
+                                                         if entry['campaign_id'] == campaign_id]
+
+    # a tiny buffer forces the files to be evicted and reopened in append mode
+    pool = utils.FilePool(client._open_file, max_open=2, max_buffered=1)
+    for index, entry in enumerate(entries):
+        pool.write('pool/{}.data'.format(index % 5), client.serializer.dumps(entry))
+    assert len(pool.files) == 2
+    pool.close()
+    assert pool.evictions > 5
+    assert list(client._read_entries('pool/0.data')) == entries[::5]
+
+    # evicted files are spooled locally for storages that can not append, and written to them once
+    storage = _RemoteStorage()
+    pool = utils.FilePool(AdWords(storage=storage, compression=compression)._open_file, max_open=2, max_buffered=1,
+                          append=False)
+    for index, entry in enumerate(entries):
+        pool.write('pool/{}.data'.format(index % 5), client.serializer.dumps(entry))
+    assert storage.files == {}
+    pool.close()
+    assert pool.evictions > 5
+    assert list(AdWords(storage=storage, compression=compression)._read_entries('pool/0.data')) == entries[::5]
+
+    client = AdWords(storage=_RemoteStorage(), compression=compression, max_open_files=2)
+    client.insert(entries)
+    operations_folder = client.split()
+    for campaign_id in range(1000, 1005):
+        file_name = '{}/{}.data'.format(operations_folder, campaign_id)
+        assert list(client._read_entries(file_name)) == [entry for entry in entries
+                                                         if entry['campaign_id'] == campaign_id]
+    client = AdWords(storage=_RemoteStorage(), compression=compression, partition_by='campaign', max_open_files=2)
+    client.insert(entries)
+    operations_folder = client.split()
+    assert sorted(entry['campaign_id'] for entry in client._read_from_folder(operations_folder)) == \
+        sorted(entry['campaign_id'] for entry in entries)
+
+
+def _pack_operations():
+    from adwords_client.internal_api.packing import CampaignPacker
+    packer = CampaignPacker(max_operations=3)
+    for client_id, campaign_id, operations in [(1, 10, 2), (1, 11, 2), (1, 12, 1), (1, 13, 5), (2, 20, 1)]:
+        for _ in range(operations):
+            packer.add(client_id, campaign_id)
+    assert packer.pack() == {(1, 10): 0, (1, 11): 1, (1, 12): 0, (1, 13): 2, (2, 20): 0}
+
+    entries = [dict(_buffer_entries()[0], client_id=client_id, campaign_id=campaign_id)
+               for client_id, campaign_id in [(1, 10), (1, 11), (2, 20), (1, 10), (1, 12), (1, 11)]]
+    client = AdWords()
+    client.insert(entries)
+    operations_folder = client.split(max_job_operations=3)
+    _, files = client.storage.listdir(operations_folder)
+    assert sorted(files) == ['1-0000.data', '1-0001.data', '2-0000.data', 'manifest.json']
+    jobs = {(1, 10): '1-0000', (1, 12): '1-0000', (1, 11): '1-0001', (2, 20): '2-0000'}
+    for job in set(jobs.values()):
+        file_name = '{}/{}.data'.format(operations_folder, job)
+        assert list(client._read_entries(file_name)) == [
+            entry for entry in entries if jobs[entry['client_id'], entry['campaign_id']] == job
+        ]
+
+
+def _manifest_operations():
+    import hashlib
+    entries = [dict(entry, campaign_id=1001) for entry in _buffer_entries()]
+    client = AdWords(compression='gzip')
+    client.insert(entries)
+    client.insert(dict(entries[0], campaign_id=1002, client_id=1234567890))
+    operations_folder = client.split()
+    manifest = client.read_manifest(operations_folder)
+    assert sorted(manifest['files']) == ['1001.data', '1002.data']
+    data = b''.join(client.serializer.dumps(entry) for entry in entries)
+    assert manifest['files']['1001.data'] == {
+        'client_ids': [7857288943, '7857288943', 2 ** 70],
+        'operations': {'campaign': 1, 'keyword': 1, 'unknown_type': 1, 'null': 1},
+        'bytes': len(data),
+        'checksum': hashlib.sha256(data).hexdigest(),
+    }
+    assert manifest['files']['1002.data']['client_ids'] == [1234567890]
+    assert list(client._list_data_files(operations_folder).items()) == [('1001.data', None), ('1002.data', None)]
+
+    bjs = _FakeBatchJobService()
+    bjs.prepare_job(7857288943)
+    client.log_batchjob(bjs, '{}/1001.data.result'.format(operations_folder))
+    client.flush_files()
+    assert client._list_data_files(operations_folder)['1001.data'] == '1001.data.result'
+    assert list(client._collect_jobs(operations_folder)['pending']) == [7857288943]
+
+    # the files of the folder are listed once, instead of looking up each of them
+    exists = client.storage.exists
+    lookups = []
+    client.storage.exists = lambda name: lookups.append(name) or exists(name)
+    try:
+        assert client._select_data_files(operations_folder) == ['1001.data', '1002.data']
+    finally:
+        client.storage.exists = exists
+    assert lookups == ['{}/manifest.json'.format(operations_folder)]
+
+    # the files can only be read with the serializer and compression they were written with
+    for other in [AdWords(storage=client.storage), AdWords(storage=client.storage, serializer='binary',
+                                                           compression='gzip')]:
+        try:
+            other._select_data_files(operations_folder)
+            assert False
+        except ValueError as e:
+            assert 'json serializer and gzip compression' in str(e)
+
+    # the serializer picked by auto depends on the host, the one of the folder is used instead
+    other = AdWords(storage=client.storage, serializer='auto', compression='gzip')
+    assert other._select_data_files(operations_folder) == ['1001.data', '1002.data']
+    assert other.serializer.name == 'json'
+    assert list(other._collect_jobs(operations_folder)['pending']) == [7857288943]
+    try:
+        AdWords(serializer='auto', buffer_name='operations')
+        assert False
+    except ValueError:
+        pass
+
+
+def _parallel_split(serializer):
+    entries = [dict(entry, client_id=7857288943, campaign_id=1000 + index % 7)
+               for index in range(50) for entry in _buffer_entries()[:2]]
+    folders = []
+    for workers in [None, 3]:
+        client = AdWords(serializer=serializer)
+        client.insert(entries)
+        if workers:
+            assert len(client.operations.ranges(workers)) == 3
+        folders.append((client, client.split(workers=workers)))
+    (serial, serial_folder), (parallel, parallel_folder) = folders
+    assert parallel.read_manifest(parallel_folder) == serial.read_manifest(serial_folder)
+    for file_name in serial.read_manifest(serial_folder)['files']:
+        with serial.storage.open('{}/{}'.format(serial_folder, file_name), 'rb') as serial_file:
+            with parallel.storage.open('{}/{}'.format(parallel_folder, file_name), 'rb') as parallel_file:
+                assert serial_file.read() == parallel_file.read()
+
+
+def _resolve_dependencies():
+    entries = [
+        {'object_type': 'keyword', 'client_id': 1, 'campaign_id': 10, 'adgroup_id': 100, 'criteria_id': 1000,
+         'operator': 'REMOVE'},
+        {'object_type': 'keyword', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': 110, 'criteria_id': 1100,
+         'operator': 'SET', 'cpc_bid': 1.5},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': -2, 'adgroup_name': 'new'},
+        {'object_type': 'keyword', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': 111, 'criteria_id': 1110,
+         'operator': 'SET', 'cpc_bid': 2.5},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 10, 'adgroup_id': 100, 'operator': 'REMOVE'},
+        {'object_type': 'campaign', 'client_id': 1, 'campaign_id': -1, 'campaign_name': 'new'},
+        {'object_type': 'campaign', 'client_id': 1, 'campaign_id': 10, 'operator': 'REMOVE'},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': 111, 'status': 'REMOVED'},
+        # same ids on another client are not affected
+        {'object_type': 'keyword', 'client_id': 2, 'campaign_id': 10, 'adgroup_id': 100, 'criteria_id': 1000,
+         'operator': 'REMOVE'},
+    ]
+    client = AdWords()
+    client.insert(entries)
+    client.min_id = -2
+    assert client.resolve_dependencies() == 3
+    assert list(client._read_buffer()) == [entries[5], entries[6], entries[2], entries[7], entries[1], entries[8]]
+    assert client.min_id == -2
+
+    # a campaign or ad group added and removed is never created, its REMOVE and its children are dropped too
+    entries = [
+        {'object_type': 'campaign', 'client_id': 1, 'campaign_id': -3, 'campaign_name': 'temp'},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': -3, 'adgroup_id': -4, 'adgroup_name': 'temp'},
+        {'object_type': 'keyword', 'client_id': 1, 'adgroup_id': -4, 'text': 'temp'},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': -5, 'adgroup_name': 'temp'},
+        {'object_type': 'ad', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': -5, 'description': 'temp'},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': -5, 'operator': 'REMOVE'},
+        {'object_type': 'campaign', 'client_id': 1, 'campaign_id': -3, 'operator': 'REMOVE'},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': -6, 'adgroup_name': 'kept'},
+    ]
+    client = AdWords()
+    client.insert(entries)
+    assert client.resolve_dependencies() == 7
+    assert list(client._read_buffer()) == [entries[7]]
+
+
+def _sort_operations():
+    entries = [
+        {'object_type': 'keyword', 'client_id': 2, 'campaign_id': 20, 'adgroup_id': 200, 'criteria_id': 1},
+        {'object_type': 'adgroup', 'client_id': 1, 'campaign_id': -1, 'adgroup_id': -2},
+        {'object_type': 'keyword', 'client_id': 1, 'campaign_id': -1, 'adgroup_id': -2, 'criteria_id': 2},
+        {'object_type': 'campaign', 'client_id': 1, 'campaign_id': -1},
+        {'object_type': 'keyword', 'client_id': 2, 'campaign_id': 20, 'adgroup_id': 200, 'criteria_id': 3},
+        {'object_type': 'keyword', 'client_id': 1, 'campaign_id': 10, 'adgroup_id': 100, 'criteria_id': 4},
+        {'object_type': 'keyword', 'client_id': 1, 'campaign_id': -1, 'adgroup_id': -2, 'criteria_id': 5},
+        {'client_id': 1},
+    ]
+    client = AdWords(compression='gzip')
+    client.insert(entries)
+    assert client.sort(max_rows=3) == 3
+    assert [entry.get('criteria_id') for entry in client._read_buffer()] == [None, None, None, 2, 5, 4, 1, 3]
+    assert client.sort(key=['criteria_id']) == 1
+    assert [entry.get('criteria_id') for entry in client._read_buffer()] == [None, None, None, 1, 2, 3, 4, 5]
+
+
+def _shard_operations():
+    entries = [{'object_type': 'campaign', 'client_id': 1, 'campaign_id': 10, 'operator': 'SET'}]
+    for criteria_id in range(12):
+        entries.append({'object_type': 'keyword', 'client_id': 1, 'campaign_id': 10,
+                        'adgroup_id': [100, -2, 101, 102][criteria_id % 4], 'criteria_id': criteria_id})
+    entries.extend({'object_type': 'keyword', 'client_id': 1, 'campaign_id': -1, 'adgroup_id': 100 + index,
+                    'criteria_id': index} for index in range(6))
+    entries.append({'object_type': 'keyword', 'client_id': 1, 'campaign_id': 11, 'adgroup_id': 110, 'criteria_id': 1})
+    client = AdWords()
+    client.insert(entries)
+    operations_folder = client.split(max_campaign_operations=5)
+    files = client.read_manifest(operations_folder)['files']
+    assert sorted(files) == ['-1.data', '10-0001.data', '10-0002.data', '10-0003.data', '10.data', '11.data']
+    assert [files[name]['bytes'] > 0 for name in files] == [True] * 6
+    adgroups = {}
+    for name in files:
+        for entry in client._read_entries('{}/{}'.format(operations_folder, name)):
+            adgroups.setdefault(name, set()).add(entry.get('adgroup_id'))
+    assert adgroups['10.data'] == {None, 100}
+    assert [adgroups['10-{:04d}.data'.format(shard)] for shard in range(1, 4)] == [{-2}, {101}, {102}]
+
+    # the shards are packed like any other campaign
+    operations_folder = client.split(max_campaign_operations=5, max_job_operations=5)
+    files = client.read_manifest(operations_folder)['files']
+    assert [files['1-{:04d}.data'.format(job)]['bytes'] > 0 for job in range(5)] == [True] * 5
+
+
+def _plan_operations(workdir):
+    from adwords_client.adwords_api.batch_job_xml import schemaless_operations_xml
+    entries = [
+        {'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': -1, 'budget': 1000,
+         'campaign_name': 'API test campaign', 'locations': [1001773, 1001768], 'languages': [1014, 1000],
+         'status': 'PAUSED'},
+        {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'adgroup_name': 'API test adgroup', 'cpc_bid': 13.37},
+        {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'text': 'my search term', 'keyword_match_type': 'broad', 'status': 'PAUSED', 'cpc_bid': 13.37},
+        {'object_type': 'keyword', 'client_id': 1234567890, 'campaign_id': 10, 'adgroup_id': 100,
+         'criteria_id': 1000, 'cpc_bid': 4.20, 'operator': 'SET'},
+    ]
+    client = AdWords()
+    client.insert(entries)
+    report = client.plan()
+    assert {key: report[key] for key in ['route', 'jobs', 'uploads', 'requests', 'operations']} == {
+        'route': 'batch', 'jobs': 2, 'uploads': 2, 'requests': 0, 'operations': 9,
+    }
+    assert report['services'] == {'BudgetService': 1, 'CampaignService': 1, 'CampaignCriterionService': 4,
+                                  'AdGroupService': 1, 'AdGroupCriterionService': 2}
+    assert report['units'] == report['operations'] + report['jobs'] == 11
+    bid_operation = next(OperationsBuilder()(entries[3]))
+    assert report['clients'][1234567890] == {'jobs': 1, 'operations': 1, 'units': 2,
+                                             'bytes': len(schemaless_operations_xml([bid_operation]))}
+    assert report['bytes'] == sum(client['bytes'] for client in report['clients'].values()) > 0
+
+    # the same run, from the split files
+    operations_folder = client.split()
+    assert client.plan(operations_folder) == report
+    # the data files are closed once read
+    assert client.open_files == {}
+
+    client = AdWords()
+    client.insert([{'object_type': 'label', 'client_id': 1, 'label': 'label {}'.format(index)}
+                   for index in range(1001)])
+    report = client.plan(sync=True)
+    assert (report['route'], report['requests'], report['services']) == ('sync', 2, {'LabelService': 1001})
+    assert report['units'] == 1001
+
+    # the campaigns of a client go to a single job when partitioning by client
+    campaigns = [dict(entries[3], campaign_id=campaign_id) for campaign_id in [10, 11]]
+    client = AdWords()
+    client.insert(campaigns)
+    assert client.plan()['jobs'] == 2
+    client = AdWords(partition_by='client')
+    client.insert(campaigns)
+    assert client.plan()['jobs'] == 1
+
+    # a reopened durable buffer gives the temporary ids of the new entities as its first client did
+    client = AdWords(workdir=workdir, buffer_name='ingest')
+    client.insert(dict(entries[0], campaign_id=-10))
+    report = client.plan()
+    client.operations.close()
+    assert AdWords(workdir=workdir, buffer_name='ingest').plan() == report
+
+
+def _partition_at_insert(workdir, compression):
+    from io import StringIO
+    entries = [dict(entry, client_id=7857288943 + index % 2, campaign_id=1000 + index % 3)
+               for index in range(30) for entry in _buffer_entries()[:1]]
+    entries.append(dict(entries[0], campaign_id=-5))
+    client = AdWords(workdir=workdir, compression=compression)
+    client.insert(entries)
+    split_folder = client.split()
+
+    client = AdWords(workdir=workdir, compression=compression, partition_by='campaign', max_open_files=2)
+    client.insert(entries[:10])
+    client.insert_file(StringIO(''.join(json.dumps(entry) + '\n' for entry in entries[10:])), 'jsonl')
+    assert client.min_id == -5
+    assert list(client._read_buffer()) == sorted(entries, key=lambda entry: [1000, 1001, 1002, -5].index(
+        entry['campaign_id']))
+    operations_folder = client.split()
+    assert client.read_manifest(operations_folder) == client.read_manifest(split_folder)
+    assert client.min_id == -5
+    for file_name in client.read_manifest(operations_folder)['files']:
+        assert list(client._read_entries('{}/{}'.format(operations_folder, file_name))) == \
+            list(client._read_entries('{}/{}'.format(split_folder, file_name)))
+    # the next inserts start a new folder
+    client.insert(entries[0])
+    assert client.split() != operations_folder
+
+    client = AdWords(compression=compression, partition_by='client')
+    client.insert(entries)
+    try:
+        client.split(max_job_operations=3)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the data files written at insert time can not be packed')
+    files = client.read_manifest(client.split())['files']
+    assert [(name, stats['client_ids']) for name, stats in files.items()] == [
+        ('7857288943.data', [7857288943]), ('7857288944.data', [7857288944]),
+    ]
+
+
+def _record_operations():
+    from adwords_client.internal_api.records import Record, make_record
+    entries = [
+        {'object_type': 'campaign', 'client_id': '7857288943', 'campaign_id': -1, 'budget': 1000,
+         'campaign_name': 'API test campaign', 'locations': [1001773, 1001768], 'languages': [1014, 1000],
+         'status': 'PAUSED'},
+        {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'adgroup_name': 'API test adgroup', 'cpc_bid': 13.37, 'bid_modifier': None},
+        {'object_type': 'keyword', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'text': 'my search term', 'keyword_match_type': 'broad', 'status': 'PAUSED', 'cpc_bid': 13.37},
+        {'object_type': 'ad', 'client_id': 7857288943, 'campaign_id': -1, 'adgroup_id': -2,
+         'headline_part_1': 'Ad test', 'headline_part_2': 'my pretty test', 'description': 'This is my test ad',
+         'path_1': 'test', 'path_2': 'ad', 'final_urls': 'http://www.mytest.com/'},
+        {'object_type': 'label', 'client_id': 7857288943, 'label': 'my label'},
+        {'object_type': 'campaign', 'client_id': 7857288943, 'campaign_id': 10, 'operator': 'REMOVE'},
+        {'object_type': 'adgroup', 'client_id': 7857288943, 'campaign_id': 10, 'adgroup_id': 11,
+         'operator': 'REMOVE'},
+    ]
+    for entry in entries:
+        dict_operations = list(OperationsBuilder()(dict(entry)))
+        record = make_record(entry)
+        assert isinstance(record, Record) and not hasattr(record, '__dict__')
+        assert make_record(record) is record
+        assert list(OperationsBuilder()(record)) == dict_operations
+    record = make_record(entries[0])
+    assert (record['client_id'], record['budget'], record['locations']) == (7857288943, 1000000000, [1001773, 1001768])
+    assert 'bid_modifier' not in make_record(entries[1]) and record.get('adgroup_id') is None
+    assert dict(make_record({'object_type': 'customer', 'client_id': 1})) == {'client_id': 1, 'object_type': 'customer'}
+    try:
+        record['object_type'] = 'adgroup'
+        assert False
+    except KeyError:
+        pass
+
+
+def test_serialize_operations():
+    _serialize_operations('json')
+    _serialize_operations('binary')
+    _serialize_operations('orjson')
+    _serialize_operations('auto')
+
+
+def test_spool_operations():
+    _spool_operations()
+
+
+def test_track_min_id():
+    _track_min_id()
+
+
+def test_insert_files():
+    _insert_files()
+
+
+def test_compress_operations():
+    _compress_operations('gzip', 'json')
+    _compress_operations('lzma', 'binary')
+
+
+def test_durable_operations(tmp_path):
+    _durable_operations(str(tmp_path / 'plain'), None)
+    _durable_operations(str(tmp_path / 'gzip'), 'gzip')
+
+
+def test_concurrent_insert(tmp_path):
+    _concurrent_insert(str(tmp_path))
+
+
+def test_coalesce_operations():
+    _coalesce_operations()
+
+
+def test_split_operations():
+    _split_operations(None)
+    _split_operations('lzma')
+
+
+def test_pack_operations():
+    _pack_operations()
+
+
+def test_manifest_operations():
+    _manifest_operations()
+
+
+def test_parallel_split():
+    _parallel_split('json')
+    _parallel_split('orjson')
+
+
+def test_resolve_dependencies():
+    _resolve_dependencies()
+
+
+def test_sort_operations():
+    _sort_operations()
+
+
+def test_shard_operations():
+    _shard_operations()
+
+
+def test_plan_operations(tmp_path):
+    _plan_operations(str(tmp_path))
+
+
+def test_partition_at_insert(tmp_path):
+    _partition_at_insert(str(tmp_path / 'plain'), None)
+    _partition_at_insert(str(tmp_path / 'gzip'), 'gzip')
+
+
+def test_record_operations():
+    _record_operations()
+
+
+def test_update_bids():
+    _update_bids()
+
+
+def test_pipelined_uploads():
+    _pipelined_uploads()
+
+
+def test_chunk_uploads():
+    _chunk_uploads()
+
+
+def test_resume_uploads(tmp_path):
+    _resume_uploads(str(tmp_path / 'plain'), None)
+    _resume_uploads(str(tmp_path / 'gzip'), 'gzip')
+    _resume_uploads(str(tmp_path / 'plain-pipelined'), None, upload_queue_size=2)
+    _resume_uploads(str(tmp_path / 'gzip-pipelined'), 'gzip', upload_queue_size=2)
+
+
+def test_resume_temporary_ids(tmp_path):
+    _resume_temporary_ids(str(tmp_path))
+
+
+def test_retry_policy():
+    _retry_policy()
+
+
+def test_precompiled_xml():
+    _precompiled_xml()
+
+
 def _assert_jobs(jobs):
     assert not jobs['dirty']
     assert not jobs['pending']